@@ -0,0 +1,140 @@
+"""
+Admission control for rpc endpoints, limits concurrent calls and rejects calls early when overloaded
+"""
+
+import asyncio
+import asyncio.log
+import os
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+
+# concurrent calls, queued calls
+Limit = Tuple[int, int]
+
+# expensive endpoints, e.g. blocking ssh commands
+ENDPOINT_LIMITS: Dict[str, Limit] = {
+    'cli_command': (2, 8),
+    'reset': (2, 8),
+    'console': (4, 16),
+    'forward': (2, 8),
+}
+# shared by all cheap read endpoints, so they are never starved by others
+READ_LANE: Limit = (32, 256)
+# shared by all other endpoints
+DEFAULT_LANE: Limit = (16, 64)
+# calling other endpoints, which are admitted on their own
+UNLIMITED_ENDPOINTS = {'batch'}
+
+
+class Limiter:
+    """
+    Concurrency limit with a bounded FIFO queue
+    """
+
+    def __init__(self, limit: int, max_queue: int) -> None:
+        self.limit = limit
+        self.max_queue = max_queue
+        self.running: int = 0
+        self.rejected: int = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self) -> bool:
+        """
+        Wait for a free slot, False without waiting if the queue is full
+        """
+        if self.running < self.limit and not self._waiters:
+            self.running += 1
+            return True
+        if len(self._waiters) >= self.max_queue:
+            self.rejected += 1
+            return False
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()  # the slot has been handed over already
+            else:
+                self._waiters.remove(waiter)
+            raise
+        return True
+
+    def release(self):
+        # hand the slot over to the next waiter
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.running -= 1
+
+
+def parse_limits(spec: str) -> Dict[str, Limit]:
+    """
+    Parse limits like 'cli_command=2:8,reset=1:4'
+    """
+    limits = {}
+    for entry in filter(None, (part.strip() for part in spec.split(','))):
+        endpoint, _, limit = entry.partition('=')
+        concurrent, _, queued = limit.partition(':')
+        limits[endpoint.strip()] = (int(concurrent), int(queued or 0))
+    return limits
+
+
+class AdmissionControl:
+    """
+    Per endpoint limits plus a reserved lane for read endpoints and a lane for all others
+    """
+
+    def __init__(self, read_endpoints: Iterable[str], limits: Optional[Dict[str, Limit]] = None,
+                 read_lane: Limit = READ_LANE, default_lane: Limit = DEFAULT_LANE) -> None:
+        self.read_endpoints = set(read_endpoints)
+        self.endpoints = {name: Limiter(*limit) for name, limit in (limits or ENDPOINT_LIMITS).items()}
+        self.read_lane = Limiter(*read_lane)
+        self.default_lane = Limiter(*default_lane)
+
+    @classmethod
+    def from_env(cls, read_endpoints: Iterable[str]) -> "AdmissionControl":
+        """
+        Default limits, overridden by LABBY_ENDPOINT_LIMITS
+        """
+        limits = dict(ENDPOINT_LIMITS)
+        spec = os.environ.get('LABBY_ENDPOINT_LIMITS', '')
+        try:
+            limits.update(parse_limits(spec))
+        except ValueError:
+            asyncio.log.logger.error(f"Invalid LABBY_ENDPOINT_LIMITS '{spec}', using the default limits.")
+        return cls(read_endpoints, limits)
+
+    async def admit(self, endpoint: str) -> Optional[List[Limiter]]:
+        """
+        Acquire the endpoint's limiters, None if the call has to be rejected.
+        Pass the returned limiters to release once the call is done.
+        """
+        if endpoint in UNLIMITED_ENDPOINTS:
+            return []
+        limiters = []
+        if (limiter := self.endpoints.get(endpoint)) is not None:
+            limiters.append(limiter)
+        limiters.append(self.read_lane if endpoint in self.read_endpoints else self.default_lane)
+        acquired: List[Limiter] = []
+        try:
+            for limiter in limiters:
+                if not await limiter.acquire():
+                    self.release(acquired)
+                    return None
+                acquired.append(limiter)
+        except asyncio.CancelledError:
+            self.release(acquired)
+            raise
+        return acquired
+
+    @staticmethod
+    def release(limiters: List[Limiter]):
+        for limiter in reversed(limiters):
+            limiter.release()
@@ -1,11 +1,14 @@
 from abc import abstractmethod
 import asyncio
-import contextlib
-from asyncio import CancelledError
+from collections import OrderedDict
 from inspect import iscoroutinefunction
-from typing import Any, Awaitable, Callable, Generic, List, TypeVar, Union
+from time import monotonic, perf_counter, time
+from typing import Any, Awaitable, Callable, Dict, Generic, Hashable, Iterable, List, Optional, Set, Tuple, TypeVar, Union
 from attr import attrib, attrs
 
+from labby.scheduler import Scheduler, get_scheduler
+from labby.stats import CacheStats
+
 
 class CacheStrategy:
     def __init__(self) -> None:
@@ -35,23 +38,41 @@ class TimingStrategy:
 
 
 class PeriodicRefreshStrategy(CacheStrategy, TimingStrategy):
-    def __init__(self, period: float):
+    def __init__(self, period: float, scheduler: Optional[Scheduler] = None):
         CacheStrategy.__init__(self)
         TimingStrategy.__init__(self)
+        self.period = period
+        # expiry is tracked by the shared scheduler, no task per strategy
+        self._scheduler = scheduler or get_scheduler()
+        self._expiry = self._scheduler.call_later(period, self._expire)
 
-        async def clear_in_background():
-            with contextlib.suppress(CancelledError):
-                while True:
-                    while self._expired:
-                        # too soon after last refresh
-                        await asyncio.sleep(0.5)
-                    await asyncio.sleep(delay=period)
-                    self._expired = True
+    def _expire(self):
+        self._expired = True
 
-        self.clear_task = asyncio.get_event_loop().create_task(clear_in_background())
+    def reset(self):
+        self._expired = False
+        self._expiry.cancel()
+        self._expiry = self._scheduler.call_later(self.period, self._expire)
 
     def stop(self):
-        self.clear_task.cancel()
+        self._expiry.cancel()
+
+
+class TTLStrategy(CacheStrategy):
+    """
+    Expire ttl seconds after the last refresh, checked on read without a timer
+    """
+
+    def __init__(self, ttl: float):
+        CacheStrategy.__init__(self)
+        self.ttl = ttl
+        self._refreshed_at: Optional[float] = None
+
+    def should_refresh(self) -> bool:
+        return self._refreshed_at is None or monotonic() - self._refreshed_at > self.ttl
+
+    def reset(self):
+        self._refreshed_at = monotonic()
 
 
 @attrs
@@ -79,6 +100,10 @@ class CounterStrategy(CacheStrategy, GetStrategy):
 T = TypeVar("T")
 
 
+async def _shielded(future: asyncio.Future):
+    return await asyncio.shield(future)
+
+
 class Cache(Generic[T]):
     def __init__(
         self,
@@ -86,10 +111,33 @@ class Cache(Generic[T]):
         refresh_data: Union[Callable[[Any], T],
                             Callable[[Any], Awaitable[T]]] = attrib(),
         strategies: List[CacheStrategy] = attrib(),
+        single_flight: bool = False,
+        stale_while_revalidate: bool = False,
+        max_staleness: Optional[float] = None,
+        stats: Optional[CacheStats] = None,
     ):
         self.data = data
+        self.stats = stats if stats is not None else CacheStats()
         self.refresh_data = refresh_data
         self.strategies = strategies
+        # share one pending refresh between concurrent readers
+        self.single_flight = single_flight
+        # serve expired data and refresh it in the background,
+        # unless the data is older than max_staleness seconds
+        self.stale_while_revalidate = stale_while_revalidate
+        self.max_staleness = max_staleness
+        self.last_refresh: Optional[float] = None
+        # incremented on every refresh and every applied delta
+        self.version: int = 0
+        self._invalidated: bool = False
+        # data was restored from a snapshot and has not been refreshed yet
+        self.stale: bool = False
+        self._pending: List[Callable[[T], None]] = []
+        # called with the new data whenever it is replaced completely
+        self.on_refresh: List[Callable[[T], None]] = []
+        # called whenever the data is invalidated
+        self.on_invalidate: List[Callable[[], None]] = []
+        self._inflight: Optional[asyncio.Future] = None
         if hasattr(self.data, "__getitem__"):
 
             def __getitem__(self, ind: Any) -> T:
@@ -122,24 +170,131 @@ class Cache(Generic[T]):
         # access data without refreshing cache
         return self.data
 
+    def invalidate(self):
+        """
+        Force a full refresh on the next read, e.g. after a reconnect
+        """
+        self._invalidated = True
+        for listener in self.on_invalidate:
+            listener()
+
+    def seed(self, data: T, version: int = 0, last_refresh: Optional[float] = None):
+        """
+        Fill the cache with previously stored data, e.g. from a snapshot.
+        The data is served as stale until the first refresh completes.
+        """
+        self.data = data
+        self.version = version
+        self.last_refresh = last_refresh
+        self.stale = True
+        self.invalidate()
+        for listener in self.on_refresh:
+            listener(data)
+
+    def should_refresh(self) -> bool:
+        return self._invalidated or any(strat.should_refresh() for strat in self.strategies)
+
+    def is_too_stale(self) -> bool:
+        """
+        True if the cached data is older than the configured max staleness
+        """
+        if self.max_staleness is None or self.last_refresh is None or self.stale:
+            # stale snapshot data is better than waiting for the coordinator
+            return False
+        return time() - self.last_refresh > self.max_staleness
+
+    def apply(self, delta: Callable[[T], None], default: Optional[Callable[[], T]] = None) -> bool:
+        """
+        Apply an incremental update to the cached data in place.
+        Deltas arriving during a refresh are replayed on the refreshed data.
+        If there is no data yet, it is seeded from default and a full refresh
+        is scheduled, since earlier deltas have been missed.
+        Returns False if the delta could not be applied, the cache is invalidated in that case.
+        """
+        if self._inflight is not None:
+            self._pending.append(delta)
+        if self.data is None:
+            if default is None or self._inflight is not None:
+                return True  # the pending refresh fetches everything anyway
+            self.data = default()
+            self.invalidate()
+        return self._apply_now(delta)
+
+    def _apply_now(self, delta: Callable[[T], None]) -> bool:
+        try:
+            delta(self.data)
+        except (KeyError, TypeError, AttributeError):
+            # the delta does not fit our data, we missed something
+            self.invalidate()
+            return False
+        self.version += 1
+        return True
+
+    def _refreshed(self, data: T) -> T:
+        self.data = data
+        self.last_refresh = time()
+        self.version += 1
+        self._invalidated = False
+        self.stale = False
+        for strat in self.strategies:
+            strat.reset()
+        for listener in self.on_refresh:
+            listener(data)
+        # replay deltas received while the refresh was in flight
+        pending, self._pending = self._pending, []
+        for delta in pending:
+            self._apply_now(delta)
+        return data
+
+    async def _refresh_task(self, *args) -> T:
+        start = perf_counter()
+        try:
+            data = await self.refresh_data(*args)
+        except Exception:
+            self.stats.refresh_errors += 1
+            raise
+        self.stats.refreshed(perf_counter() - start, data)
+        return self._refreshed(data)
+
+    def _start_refresh(self, *args) -> asyncio.Future:
+        if self._inflight is None:
+            self._inflight = asyncio.ensure_future(self._refresh_task(*args))
+
+            def _done(fut: asyncio.Future):
+                self._inflight = None
+                self._pending.clear()
+                if not fut.cancelled():
+                    fut.exception()  # mark retrieved, readers get it from their own await
+            self._inflight.add_done_callback(_done)
+        return self._inflight
+
+    async def _refresh_async(self, *args) -> T:
+        if not self.single_flight:
+            return await self._refresh_task(*args)
+        inflight = self._start_refresh(*args)
+        if inflight.done():
+            return inflight.result()
+        if inflight.get_loop() is not asyncio.get_running_loop():
+            # started on another loop, e.g. the labby loop while the frontend router reads
+            return await asyncio.wrap_future(
+                asyncio.run_coroutine_threadsafe(_shielded(inflight), inflight.get_loop()))
+        # shield, so a cancelled reader does not cancel the refresh for all others
+        return await asyncio.shield(inflight)
+
     def make_get(self, isasync: bool):
         def get(*args) -> T:
             # TODO could we optimize this?
             for strat in self.strategies:
                 if isinstance(strat, GetStrategy):
                     strat.get_action()
-            reset_strats = False
-            if self.data is None:
-                self.data = self.refresh_data(*args)
+            if self.data is None or self.should_refresh():
+                self.stats.misses += 1
+                start = perf_counter()
+                data = self.refresh_data(*args)
+                self.stats.refreshed(perf_counter() - start, data)
+                self._refreshed(data)
             else:
-                for strat in self.strategies:
-                    if strat.should_refresh():
-                        self.data = self.refresh_data(*args)
-                        reset_strats = True
-                        break
-                if reset_strats:
-                    for strat in self.strategies:
-                        strat.reset()
+                self.stats.hits += 1
             return self.data  # type: ignore
 
         async def get_async(*args) -> T:
@@ -147,18 +302,89 @@ class Cache(Generic[T]):
             for strat in self.strategies:
                 if isinstance(strat, GetStrategy):
                     strat.get_action()
-            reset_strats = False
-            if self.data is None:
-                self.data = await self.refresh_data(*args)
+            if self.data is None or (self._invalidated and self.last_refresh is None and not self.stale):
+                # nothing complete to serve yet
+                self.stats.misses += 1
+                await self._refresh_async(*args)
+            elif self.should_refresh():
+                if self.stale_while_revalidate and not self.is_too_stale():
+                    self.stats.stale_hits += 1
+                    self._start_refresh(*args)
+                else:
+                    self.stats.misses += 1
+                    await self._refresh_async(*args)
             else:
-                for strat in self.strategies:
-                    if strat.should_refresh():
-                        self.data = await self.refresh_data(*args)
-                        reset_strats = True
-                        break
-                if reset_strats:
-                    for strat in self.strategies:
-                        strat.reset()
+                self.stats.hits += 1
             return self.data  # type: ignore
 
         return get_async if isasync else get
+
+
+MISSING = object()
+
+
+class ResultCache:
+    """
+    Bounded LRU cache with a TTL for results of parameterised queries.
+    Entries are tagged, so a change only invalidates the results depending on it.
+    """
+
+    def __init__(self, maxsize: int = 512, ttl: float = 30., stats: Optional[CacheStats] = None) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stats = stats if stats is not None else CacheStats()
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any, Tuple[str, ...]]]" = OrderedDict()
+        self._tags: Dict[str, Set[Hashable]] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Any:
+        """
+        Return the cached result for key or MISSING
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.stats.misses += 1
+            return MISSING
+        expires, value, _ = entry
+        if expires < perf_counter():
+            self._remove(key)
+            self.stats.misses += 1
+            return MISSING
+        self._entries.move_to_end(key)
+        self.stats.hits += 1
+        return value
+
+    def put(self, key: Hashable, value: Any, tags: Iterable[str]):
+        if key in self._entries:
+            self._remove(key)
+        tags = tuple(tags)
+        self._entries[key] = (perf_counter() + self.ttl, value, tags)
+        for tag in tags:
+            self._tags.setdefault(tag, set()).add(key)
+        while len(self._entries) > self.maxsize:
+            self._remove(next(iter(self._entries)))
+
+    def invalidate(self, *tags: str):
+        """
+        Drop all results tagged with any of tags
+        """
+        for tag in tags:
+            for key in self._tags.pop(tag, ()):
+                self._remove(key)
+
+    def clear(self):
+        self._entries.clear()
+        self._tags.clear()
+
+    def _remove(self, key: Hashable):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
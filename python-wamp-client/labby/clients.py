@@ -0,0 +1,103 @@
+"""
+Frontend sessions served by one labby, each with its own acquired places and open consoles
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional, Set
+
+from attr import attrs, attrib
+
+PlaceName = str
+SessionId = int
+Token = str
+
+
+@attrs(eq=False)
+class Client:
+    """
+    State of a single frontend session, identity None for the labby user itself
+    """
+    identity: Optional[str] = attrib(default=None)
+    session: Optional[SessionId] = attrib(default=None)
+    acquired_places: Set[PlaceName] = attrib(factory=set)
+    open_consoles: Dict[PlaceName, Any] = attrib(factory=dict)
+
+
+# client of the rpc call currently handled
+_current: ContextVar[Optional[Client]] = ContextVar('labby_client', default=None)
+
+
+class Clients:
+    """
+    Clients by frontend session. Without server mode all sessions share the default client.
+    The coordinator sees a single user, places acquired by it but held by no session
+    (e.g. by a session that left) are kept by the default client until a session adopts them.
+    """
+
+    def __init__(self, server_mode: bool = False) -> None:
+        self.server_mode = server_mode
+        self.default = Client()
+        self.sessions: Dict[SessionId, Client] = {}
+        # client that created a reservation, its place is acquired for it once allocated
+        self.reserved_by: Dict[Token, Client] = {}
+
+    def current(self) -> Client:
+        return _current.get() or self.default
+
+    def all(self) -> List[Client]:
+        return [self.default, *self.sessions.values()]
+
+    def for_caller(self, session: Optional[SessionId], authid: Optional[str] = None) -> Client:
+        if not self.server_mode or session is None:
+            return self.default
+        if (client := self.sessions.get(session)) is None:
+            client = self.sessions[session] = Client(authid or f"session/{session}", session)
+        return client
+
+    @contextmanager
+    def use(self, client: Client) -> Iterator[Client]:
+        """
+        Make client the current one for all calls within
+        """
+        token = _current.set(client)
+        try:
+            yield client
+        finally:
+            _current.reset(token)
+
+    def for_token(self, token: Token) -> Client:
+        return self.reserved_by.get(token, self.default)
+
+    def holder(self, place: PlaceName) -> Optional[Client]:
+        return next((client for client in self.all() if place in client.acquired_places), None)
+
+    def hold(self, client: Client, place: PlaceName):
+        for other in self.all():
+            other.acquired_places.discard(place)
+        client.acquired_places.add(place)
+
+    def sync(self, place: PlaceName, acquired: bool):
+        """
+        Follow the coordinator, acquired is whether the labby user holds the place
+        """
+        if not acquired:
+            for client in self.all():
+                client.acquired_places.discard(place)
+        elif self.holder(place) is None:
+            self.default.acquired_places.add(place)
+
+    def leave(self, session: SessionId) -> Optional[Client]:
+        """
+        Forget a session, close its consoles and keep its places and reservations for adoption
+        """
+        if (client := self.sessions.pop(session, None)) is None:
+            return None
+        for console in client.open_consoles.values():
+            console.close()
+        client.open_consoles.clear()
+        self.default.acquired_places |= client.acquired_places
+        for token, reserving in list(self.reserved_by.items()):
+            if reserving is client:
+                self.reserved_by[token] = self.default
+        return client
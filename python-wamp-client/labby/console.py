@@ -1,10 +1,12 @@
 import asyncio
-from typing import Union
+from typing import Optional, Union
 
 import paramiko
 from attr import attrs, field
 from paramiko.channel import ChannelFile, ChannelStderrFile, ChannelStdinFile
 
+from labby.scheduler import ScheduledCall
+
 
 def _read_flush(channel: Union[ChannelFile, ChannelStderrFile]):
     if channel.channel.closed or channel.channel.exit_status_ready():
@@ -25,6 +27,10 @@ class Console:
     ssh_session: paramiko.SSHClient = field()
     speed: int = field(default=115200)
     port: int = field(default=22)
+    # closes the console when nothing has been written to or read from it for a while
+    idle_timer: Optional[ScheduledCall] = field(default=None, init=False)
+    # loop time of the last write or read
+    last_activity: float = field(default=0., init=False)
 
     def __attrs_post_init__(self):
         assert self.ssh_session
@@ -56,6 +62,8 @@ class Console:
         return data
 
     def close(self):
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
         if self._sin:
             self._sin.flush()
             self._sin.close()
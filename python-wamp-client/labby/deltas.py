@@ -0,0 +1,55 @@
+"""
+Versioned log of changes to places and resources, for clients following a snapshot
+"""
+
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+
+class DeltaLog:
+    """
+    Ordered patches, each with the version it leads to.
+    Only the last maxlen patches are kept, older versions have to be resynced from a snapshot.
+    """
+
+    def __init__(self, maxlen: int = 1000) -> None:
+        self.version: int = 0
+        self._patches: Deque[Dict] = deque(maxlen=maxlen)
+        # called with every new patch, e.g. to publish it
+        self.listeners: List[Callable[[Dict], None]] = []
+
+    def append(self, kind: str, key: Any, data: Optional[Dict]) -> Dict:
+        """
+        Record the new state of a single place or resource, None data for deleted ones
+        """
+        self.version += 1
+        patch = {'version': self.version, 'kind': kind, 'key': key, 'data': data}
+        self._patches.append(patch)
+        self._notify(patch)
+        return patch
+
+    def reset(self) -> Dict:
+        """
+        Start over after a full refresh, clients have to fetch a new snapshot
+        """
+        self.version += 1
+        self._patches.clear()
+        patch = {'version': self.version, 'kind': 'reset', 'key': None, 'data': None}
+        self._notify(patch)
+        return patch
+
+    def since(self, version: int) -> Optional[List[Dict]]:
+        """
+        Patches after version, None if they are not available anymore
+        """
+        if version > self.version:
+            return None
+        if version == self.version:
+            return []
+        if not self._patches or self._patches[0]['version'] > version + 1:
+            return None
+        return [patch for patch in self._patches if patch['version'] > version]
+
+    def _notify(self, patch: Dict):
+        for listener in self.listeners:
+            listener(patch)
@@ -0,0 +1,213 @@
+"""
+Secondary indexes over the resource tree (exporter -> group -> name -> data)
+and over reservations
+"""
+
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+# (exporter, group, resource name)
+ResourceKey = Tuple[str, str, str]
+Resources = Dict[str, Dict[str, Dict[str, Dict]]]
+
+
+class ResourceIndex:
+    """
+    Lookups of resource keys by group (place), name, class and exporter
+    """
+
+    def __init__(self) -> None:
+        self.by_group: Dict[str, Set[ResourceKey]] = {}
+        self.by_name: Dict[str, Set[ResourceKey]] = {}
+        self.by_cls: Dict[str, Set[ResourceKey]] = {}
+        self.by_exporter: Dict[str, Set[ResourceKey]] = {}
+        self._cls: Dict[ResourceKey, Optional[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self._cls)
+
+    def __contains__(self, key: ResourceKey) -> bool:
+        return key in self._cls
+
+    def keys(self) -> Iterator[ResourceKey]:
+        return iter(self._cls)
+
+    def cls(self, key: ResourceKey) -> Optional[str]:
+        return self._cls.get(key)
+
+    def rebuild(self, resources: Optional[Resources]):
+        self.by_group.clear()
+        self.by_name.clear()
+        self.by_cls.clear()
+        self.by_exporter.clear()
+        self._cls.clear()
+        if not isinstance(resources, dict):
+            return  # not a resource tree (yet)
+        for exporter, groups in resources.items():
+            for group, entries in groups.items():
+                for name, data in entries.items():
+                    if data:
+                        self._add((exporter, group, name), data.get('cls'))
+
+    def update(self, exporter: str, group: str, name: str, data: Optional[Dict]):
+        """
+        Update the index for a single changed resource, empty data removes it
+        """
+        key = (exporter, group, name)
+        if key in self._cls:
+            self._remove(key)
+        if data:
+            self._add(key, data.get('cls'))
+
+    def lookup(self, group: Optional[str] = None, name: Optional[str] = None,
+               cls: Optional[str] = None, exporter: Optional[str] = None) -> Set[ResourceKey]:
+        """
+        Keys matching all given criteria, all keys if none are given
+        """
+        selections = [index.get(value, set()) for index, value in (
+            (self.by_group, group), (self.by_name, name),
+            (self.by_cls, cls), (self.by_exporter, exporter)) if value is not None]
+        if not selections:
+            return set(self._cls)
+        selections.sort(key=len)
+        return selections[0].intersection(*selections[1:])
+
+    def _add(self, key: ResourceKey, cls: Optional[str]):
+        exporter, group, name = key
+        self._cls[key] = cls
+        self.by_exporter.setdefault(exporter, set()).add(key)
+        self.by_group.setdefault(group, set()).add(key)
+        self.by_name.setdefault(name, set()).add(key)
+        if cls is not None:
+            self.by_cls.setdefault(cls, set()).add(key)
+
+    def _remove(self, key: ResourceKey):
+        exporter, group, name = key
+        cls = self._cls.pop(key)
+        for index, value in ((self.by_exporter, exporter), (self.by_group, group),
+                             (self.by_name, name), (self.by_cls, cls)):
+            keys = index.get(value)  # type: ignore
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del index[value]  # type: ignore
+
+
+# reservation states, which will not change anymore
+INACTIVE_STATES = ('expired', 'invalid')
+
+
+def _reservation_place(data: Any) -> Optional[str]:
+    try:
+        return data['filters']['main'].get('name')
+    except (KeyError, TypeError, AttributeError):
+        return None
+
+
+class Reservations(dict):
+    """
+    Reservations by token, with an index from place to tokens and back.
+    The index is maintained on every modification of the dict.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__()
+        self._tokens: Dict[str, Dict[str, None]] = {}  # place -> ordered set of tokens
+        self._places: Dict[str, str] = {}  # token -> place
+        # called with the place name, whenever the tokens of a place changed
+        self.on_change: List[Callable[[str], None]] = []
+        self._muted: bool = False
+        self.update(*args, **kwargs)
+
+    def token_for(self, place: str) -> Optional[str]:
+        """
+        First known reservation token for place
+        """
+        return next(iter(self._tokens.get(place, ())), None)
+
+    def tokens_for(self, place: str) -> List[str]:
+        return list(self._tokens.get(place, ()))
+
+    def place_for(self, token: str) -> Optional[str]:
+        return self._places.get(token)
+
+    def replace(self, reservations: Optional[Dict]):
+        """
+        Replace all reservations, e.g. with the coordinator's current state.
+        Expired and invalid reservations are dropped.
+        Only places whose tokens differ afterwards are reported as changed.
+        """
+        before = {place: list(tokens) for place, tokens in self._tokens.items()}
+        self._muted = True
+        try:
+            self.clear()
+            self.update({token: data for token, data in (reservations or {}).items()
+                         if not isinstance(data, dict) or data.get('state') not in INACTIVE_STATES})
+        finally:
+            self._muted = False
+        for place in [*before, *(place for place in self._tokens if place not in before)]:
+            if before.get(place, []) != self.tokens_for(place):
+                self._changed(place)
+
+    def __setitem__(self, token: str, data: Dict):
+        place = _reservation_place(data)
+        if token in self and self._places.get(token) == place:
+            # same place, the token keeps its position
+            super().__setitem__(token, data)
+            return
+        if token in self:
+            self._unindex(token)
+        super().__setitem__(token, data)
+        if place is not None:
+            self._tokens.setdefault(place, {})[token] = None
+            self._places[token] = place
+            self._changed(place)
+
+    def __delitem__(self, token: str):
+        super().__delitem__(token)
+        self._unindex(token)
+
+    def update(self, *args, **kwargs):  # pylint: disable=arguments-differ
+        for token, data in dict(*args, **kwargs).items():
+            self[token] = data
+
+    def setdefault(self, token: str, default: Optional[Dict] = None):
+        if token not in self:
+            self[token] = default  # type: ignore
+        return self[token]
+
+    def pop(self, token: str, *default):
+        if token not in self:
+            if default:
+                return default[0]
+            raise KeyError(token)
+        data = self[token]
+        del self[token]
+        return data
+
+    def popitem(self):
+        token, data = super().popitem()
+        self._unindex(token)
+        return token, data
+
+    def clear(self):
+        places = list(self._tokens)
+        super().clear()
+        self._tokens.clear()
+        self._places.clear()
+        for place in places:
+            self._changed(place)
+
+    def _changed(self, place: str):
+        if self._muted:
+            return
+        for listener in self.on_change:
+            listener(place)
+
+    def _unindex(self, token: str):
+        place = self._places.pop(token, None)
+        if place is not None:
+            tokens = self._tokens.get(place, {})
+            tokens.pop(token, None)
+            if not tokens:
+                self._tokens.pop(place, None)
+            self._changed(place)
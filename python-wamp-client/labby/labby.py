@@ -9,26 +9,43 @@ import os
 from getpass import getuser as _getuser
 from os import getenv
 from socket import gethostname as _gethostname
-from time import sleep
+from time import perf_counter, sleep
 from typing import Callable, Dict, List, Optional
 
 import autobahn.wamp.exception as wexception
 from autobahn.asyncio.wamp import ApplicationRunner, ApplicationSession
+from autobahn.wamp.types import ComponentConfig, RegisterOptions
 
 from .labby_ssh import Session as SSHSession
 from .labby_ssh import parse_hostport
 from .labby_types import (ExporterName, GroupName, PlaceName, ResourceName,
                           Session)
+from .admission import AdmissionControl
+from .labby_error import LabbyError, overloaded
+from .publisher import EventCoalescer, place_topic, power_topic, resource_topic
 
 from .router import Router
-from .rpc import (acquire, acquire_resource, add_match, cancel_reservation,
+from .rpc import (acquire, acquire_resource, add_match, batch, cancel_reservation,
                   cli_command, console, console_close, console_write, create_place,
                   create_reservation, create_resource, del_match, delete_place,
                   delete_resource, forward, get_alias, get_exporters,
-                  get_reservations, info, invalidates_cache, list_places,
-                  places, places_names, poll_reservation, power_state,
+                  get_reservations, info, list_places, metrics,
+                  place_resources, places, places_names, poll_reservation, power_state,
                   refresh_reservations, release, release_resource, reset, resource,
-                  resource_by_name, resource_names, resource_overview, username)
+                  resource_by_name, resource_names, resource_overview, resource_places,
+                  resync, snapshot, stats, username, READ_ONLY_ENDPOINTS)
+from .scheduler import get_scheduler
+from .snapshot import load_snapshot, save_snapshot, snapshots_available
+from .stats import coordinator_time
+
+# seconds between writes of the Prometheus stats file
+STATS_WRITE_INTERVAL = 15.
+# seconds between checks whether the cache snapshot has to be rewritten
+SNAPSHOT_INTERVAL = 60.
+# change events are published once none arrived for this many seconds,
+# but no later than PUBLISH_MAX_LATENCY seconds after the first one
+PUBLISH_WINDOW = 0.05
+PUBLISH_MAX_LATENCY = 0.25
 
 labby_sessions: List["LabbyClient"] = []
 frontend_sessions: List["RouterInterface"] = []
@@ -42,6 +59,32 @@ def getuser():
     return os.environ.get('LABBY_USERNAME', _getuser())
 
 
+def snapshot_path():
+    return os.environ.get('LABBY_SNAPSHOT_PATH', './.labby_snapshot.msgpack')
+
+
+def _error_kind(ret) -> Optional[str]:
+    """
+    Kind of a returned LabbyError, serialized or not
+    """
+    if isinstance(ret, LabbyError):
+        return ret.kind.value
+    if isinstance(ret, dict) and isinstance(ret.get('error'), dict):
+        return ret['error'].get('kind')
+    return None
+
+
+def publish_window():
+    return float(os.environ.get('LABBY_PUBLISH_WINDOW', PUBLISH_WINDOW))
+
+
+def server_mode() -> bool:
+    """
+    Serve every frontend session on its own, instead of sharing acquired places and consoles
+    """
+    return os.environ.get('LABBY_SERVER_MODE', '').lower() in ('1', 'true', 'yes')
+
+
 class LabbyClient(Session):
     """
     Specializes Application Session to handle Communication
@@ -56,8 +99,63 @@ class LabbyClient(Session):
         self.ssh_session = config.extra.get('ssh_session')
 
         super().__init__(config=config)
+        self.offline = True
+        self.clients.server_mode = server_mode()
+        self.events = EventCoalescer(self._publish, window=publish_window(),
+                                     max_latency=max(PUBLISH_MAX_LATENCY, publish_window()))
+        self.deltas.listeners.append(self._publish_delta)
+        self._snapshot_versions = None
+        self._load_snapshot()
         labby_sessions.append(self)
 
+    def _load_snapshot(self):
+        """
+        Serve the last known places and resources until the coordinator answers
+        """
+        caches = load_snapshot(snapshot_path())
+        if not caches:
+            return
+        for name in ('places', 'resources'):
+            entry = caches.get(name)
+            if entry and entry.get('data') is not None:
+                getattr(self, name).seed(entry['data'],
+                                         version=entry.get('version', 0),
+                                         last_refresh=entry.get('last_refresh'))
+        if (entry := caches.get('reservations')) and entry.get('data'):
+            self.reservations.update(entry['data'])
+        self.log.info(f"Loaded snapshot from {snapshot_path()}.")
+
+    def _save_snapshot(self):
+        """
+        Persist places, resources and reservations, if they changed since the last snapshot
+        """
+        if not snapshots_available() or self.places.stale or self.resources.stale:
+            return
+        if self.places.get_soft() is None or self.resources.get_soft() is None:
+            return
+        versions = (self.places.version, self.resources.version, tuple(sorted(self.reservations)))
+        if versions == self._snapshot_versions:
+            return
+        try:
+            save_snapshot(snapshot_path(), {
+                'places': {'data': self.places.get_soft(),
+                           'version': self.places.version,
+                           'last_refresh': self.places.last_refresh},
+                'resources': {'data': self.resources.get_soft(),
+                              'version': self.resources.version,
+                              'last_refresh': self.resources.last_refresh},
+                'reservations': {'data': self.reservations},
+            })
+            self._snapshot_versions = versions
+        except (OSError, TypeError, ValueError) as err:
+            self.log.error(f"Could not write snapshot to {snapshot_path()}: {err}")
+
+    def _save_snapshot_periodically(self):
+        if self not in labby_sessions:
+            return
+        self._save_snapshot()
+        get_scheduler().call_later(SNAPSHOT_INTERVAL, self._save_snapshot_periodically)
+
     def onConnect(self):
         self.log.info(
             f"Connected to Coordinator, joining realm '{self.config.realm}'")
@@ -76,20 +174,78 @@ class LabbyClient(Session):
 
     async def onJoin(self, details):
         self.log.info("Joined Coordinator Session.")
+        self.offline = False
+        # change handlers run here, events from the frontend router are handed over
+        self.events.flush()
+        self.events.loop = asyncio.get_event_loop()
         self.subscribe(self.on_place_changed,
                        "org.labgrid.coordinator.place_changed")
         self.subscribe(self.on_resource_changed,
                        "org.labgrid.coordinator.resource_changed")
+        self.subscribe(self.on_peer_joined, "wamp.session.on_join")
+        self.subscribe(self.on_peer_left, "wamp.session.on_leave")
+        # we may have missed changes while disconnected
+        self.places.invalidate()
+        self.resources.invalidate()
+        self.peers = None
         await places(self)
         await resource(self)
         asyncio.create_task(refresh_reservations(self))
+        if stats_file := os.environ.get('LABBY_STATS_FILE'):
+            self._write_stats(stats_file)
+        get_scheduler().call_later(SNAPSHOT_INTERVAL, self._save_snapshot_periodically)
+
+    def _write_stats(self, path: str):
+        """
+        Periodically dump telemetry in Prometheus text format
+        """
+        if self not in labby_sessions:
+            return
+        self.stats.gauges['scheduler_wakeups'] = get_scheduler().wakeups
+        try:
+            self.stats.write_prometheus(path)
+        except OSError as err:
+            self.log.error(f"Could not write stats to {path}: {err}")
+        get_scheduler().call_later(STATS_WRITE_INTERVAL, self._write_stats, path)
 
     def onLeave(self, details):
         self.log.info("Coordinator session disconnected.")
+        self.offline = True
+        self.events.flush()
+        self._save_snapshot()
         self.disconnect()
         labby_sessions.remove(self)
 
-    @invalidates_cache('power_states')
+    def _frontends(self) -> List["RouterInterface"]:
+        """
+        Frontend router sessions served by this labby
+        """
+        frontends = [self.frontend] if self.frontend else []
+        return frontends + [frontend for frontend in frontend_sessions
+                            if frontend.labby is self and frontend is not self.frontend]
+
+    def _publish(self, topic: str, payload):
+        # once per router, which fans the event out to all of its subscribers
+        for frontend in self._frontends():
+            frontend.publish(topic, payload)
+
+    def _publish_delta(self, patch: Dict):
+        # every patch is kept, they are only batched
+        self.events.add("localhost.onDelta", patch['version'], patch)
+
+    def _update_power_state(self, place_name: PlaceName, update_view: bool = True):
+        """
+        Recompute the power state of a changed place and notify the frontend if it flipped,
+        without update_view the caller rebuilds the place's view itself
+        """
+        state = self.power_states.update(place_name, self.places.get_soft(), self.resources.get_soft())
+        if state is not None:
+            if update_view:
+                self.place_views.set_power_state(place_name, state)
+            event = {'name': place_name, 'power_state': state}
+            self.events.add("localhost.onPowerStateChanged", place_name, event)
+            self.events.add(power_topic(place_name), place_name, event)
+
     async def on_resource_changed(self,
                                   exporter: ExporterName,
                                   group_name: GroupName,
@@ -98,68 +254,102 @@ class LabbyClient(Session):
         """
         Listen on resource changes on coordinator and update cache on changes
         """
-        res = {exporter: {group_name: {resource_name: resource_data}}}
-        if self.resources.get_soft() is None:
-            self.resources.data = res
-
-        if exporter not in self.resources.get_soft():
-            self.resources.get_soft()[exporter] = {
-                group_name: {resource_name: resource_data}}
-        else:
-            self.resources.get_soft()[exporter].get(group_name, {}).update(
-                {resource_name: resource_data})
-
-        if resource_name not in self.resources.get_soft()[exporter][group_name]:
+        known = self.resources.get_soft() or {}
+        created = resource_name not in known.get(exporter, {}).get(group_name, {})
+
+        def _apply(data: Dict):
+            if resource_data:
+                data.setdefault(exporter, {}).setdefault(group_name, {})[resource_name] = resource_data
+            else:
+                groups = data[exporter]
+                del groups[group_name][resource_name]
+                # no empty groups and exporters are left behind
+                if not groups[group_name]:
+                    del groups[group_name]
+                if not groups:
+                    del data[exporter]
+            self.resource_index.update(exporter, group_name, resource_name, resource_data)
+            self.matches.update_resource((exporter, group_name, resource_name), self.resource_index)
+
+        if not self.resources.apply(_apply, default=dict):
+            self.log.warn(
+                f"Missed changes for {exporter}/{group_name}/{resource_name}, refreshing resources.")
+        self.results.invalidate("resources", f"group:{group_name}", f"name:{resource_name}")
+        self.deltas.append('resource', [exporter, group_name, resource_name], resource_data or None)
+
+        if not resource_data:
             self.log.info(
-                f"Resource {exporter}/{group_name}/{resource_name} created.")
-        elif resource_data:
+                f"Resource {exporter}/{group_name}/{resource_name} deleted")
+        elif created:
             self.log.info(
-                f"Resource {exporter}/{group_name}/{resource_name} changed:")
+                f"Resource {exporter}/{group_name}/{resource_name} created.")
         else:
             self.log.info(
-                f"Resource {exporter}/{group_name}/{resource_name} deleted")
+                f"Resource {exporter}/{group_name}/{resource_name} changed:")
 
-        self.power_states = None  # Invalidate power state cache
-        if self.frontend:
-            self.frontend.publish("localhost.onResourceChanged",
-                                  self.resources.get_soft()[exporter][group_name][resource_name])
+        self._update_power_state(group_name)
+        event = {'exporter': exporter, 'group': group_name, 'name': resource_name, 'data': resource_data}
+        self.events.add("localhost.onResourcesChanged", (exporter, group_name, resource_name), event)
+        self.events.add(resource_topic(exporter, group_name), resource_name, event)
+
+    def on_peer_joined(self, details: Dict):
+        """
+        Keep discovered peers current, when a session joins the coordinator
+        """
+        if getattr(self, 'peers', None) is not None and 'authid' in details:
+            self.peers[details['authid']] = details
+
+    def on_peer_left(self, session_id: int, *_):
+        """
+        Keep discovered peers current, when a session leaves the coordinator
+        """
+        if getattr(self, 'peers', None) is None:
+            return
+        for authid, details in list(self.peers.items()):
+            if details.get('session') == session_id:
+                del self.peers[authid]
 
-    @invalidates_cache('power_states')
     async def on_place_changed(self, name: PlaceName, place_data: Optional[Dict] = None):
         """
         Listen on place changes on coordinator and update cache on changes
         """
-        if self.places.get_soft() is not None and not place_data:
-            del self.places[name]
+        created = name not in (self.places.get_soft() or {})
+
+        def _apply(data: Dict):
+            if not place_data:
+                del data[name]
+            elif name in data:
+                data[name].update(place_data)
+            else:
+                data[name] = place_data
+            self.matches.update_place(name, data.get(name), self.resource_index)
+
+        if not self.places.apply(_apply, default=dict):
+            self.log.warn(f"Missed changes for place {name}, refreshing places.")
+        self.results.invalidate("places", f"place:{name}")
+        # a single place delta per change
+        self._update_power_state(name, update_view=False)
+        self.place_views.update(name, (self.places.get_soft() or {}).get(name),
+                                self.power_states.states.get(name),
+                                self.reservations.token_for(name), self.places.stale)
+        if (place_data and not place_data.get('acquired')
+                and any(token in self.to_refresh for token in self.reservations.tokens_for(name))):
+            # the reserved place has been freed, pick up the allocation right away
+            self.reservation_data.invalidate()
+            self.reservation_wakeup.set()
+
+        if not place_data:
             self.log.info(f"Place {name} deleted")
-            return
-
-        if self.places.get_soft() is None:
-            self.places.data = {}
-
-        if name not in self.places.get_soft():
-            self.places.data[name] = place_data
+        elif created:
             self.log.info(f"Place {name} created.")
         else:
-            self.places.get_soft()[name].update(place_data)
             self.log.info(f"Place {name} changed.")
-        if (  # add place to acquired places, if we have acquired it previously
-            place_data
-            and place_data['acquired'] is not None
-            and place_data['acquired'] == self.user_name
-            and name not in self.acquired_places
-        ):
-            self.acquired_places.add(name)
-        if (
-            place_data
-            and name in self.acquired_places
-            and place_data['acquired'] != self.user_name
-        ):
-            self.acquired_places.remove(name)
-
-        if self.frontend:
-            self.frontend.publish("localhost.onPlaceChanged", {
-                                  'name': name, **(place_data or {})})
+        # keep the place, if we have acquired it previously, drop it from all sessions otherwise
+        self.clients.sync(name, bool(place_data) and place_data['acquired'] == self.user_name)
+
+        event = {'name': name, **(place_data or {})}
+        self.events.add("localhost.onPlacesChanged", name, event)
+        self.events.add(place_topic(name), name, event)
 
 
 class RouterInterface(ApplicationSession):
@@ -177,6 +367,9 @@ class RouterInterface(ApplicationSession):
         self.remote_url = config.extra.get("remote_url")
         self.ssh_session = config.extra.get("ssh_session")
         self.labby = None
+        # registered procedures by endpoint key, bound to labby
+        self.procedures: Dict[str, Callable] = {}
+        self.admission = AdmissionControl.from_env(READ_ONLY_ENDPOINTS)
         super().__init__(config=config)
         frontend_sessions.append(self)
 
@@ -185,56 +378,106 @@ class RouterInterface(ApplicationSession):
             f"Connected to Coordinator, joining realm '{self.config.realm}'")
         self.join(self.config.realm)
 
-    def register(self, func_key: str, procedure: Callable, *args):
+    def register(self, func_key: str, procedure: Callable, *args, progressive: bool = False):
         """
-        Register functions from RPC store from key, overrides ApplicationSession::register
+        Register functions from RPC store from key, overrides ApplicationSession::register.
+        Progressive procedures get the caller's progress callback, if it asked for progressive results.
+        Calls are admitted by the endpoint's limits and rejected with Overloaded once its queue is full.
+        Calls run as the caller's client, see Clients.
         """
         endpoint = f"localhost.{func_key}"
 
-        async def bind(*o_args):
-            return await procedure(self._labby_callback(), *args, *o_args)
+        async def bind(*o_args, details=None, **o_kwargs):
+            if progressive:
+                o_kwargs['progress'] = getattr(details, 'progress', None)
+            labby = self._labby_callback()
+            metrics = labby.stats.endpoint(func_key)
+            metrics.in_flight += 1
+            error = None
+            start = perf_counter()
+            admitted = None
+            if details is None:
+                # nested call, e.g. from batch, runs as the outer caller
+                client = labby.clients.current()
+            else:
+                client = labby.clients.for_caller(getattr(details, 'caller', None),
+                                                  getattr(details, 'caller_authid', None))
+            with coordinator_time() as coordinator, labby.clients.use(client):
+                try:
+                    admitted = await self.admission.admit(func_key)
+                    if admitted is None:
+                        ret = overloaded(f"Too many calls to {endpoint}, try again later.").to_json()
+                    else:
+                        ret = await procedure(labby, *args, *o_args, **o_kwargs)
+                    error = _error_kind(ret)
+                    return ret
+                except Exception as exc:
+                    error = type(exc).__name__
+                    raise
+                finally:
+                    if admitted:
+                        self.admission.release(admitted)
+                    metrics.in_flight -= 1
+                    metrics.observe(perf_counter() - start, coordinator[0], error)
         func = bind
+        self.procedures[func_key] = bind
         self.log.info(f"Registered function for endpoint {endpoint}.")
         try:
-            super().register(func, endpoint)
+            super().register(func, endpoint, options=RegisterOptions(details_arg='details'))
         except wexception.Error as err:
             self.log.error(
                 f"Could not register procedure: {err}.\n{err.with_traceback(None)}")
 
     async def onJoin(self, details):
         self.log.info("Joined Frontend Session.")
-        # asyncio.get_event_loop().call_soon(self._start_labby)
-        asyncio.get_event_loop().run_in_executor(None, _start_labby, self.remote_url,
-                                                 self.backend_url, self.backend_realm, self.keyfile_path, self)
+        if labby_sessions:
+            # share the coordinator session and caches of the running labby
+            self.labby = labby_sessions[0]
+        else:
+            # loads the snapshot, the coordinator session is connected in the background
+            self.labby = LabbyClient(ComponentConfig(realm=self.backend_realm, extra={'frontend': self}))
+            # asyncio.get_event_loop().call_soon(self._start_labby)
+            asyncio.get_event_loop().run_in_executor(None, _start_labby, self.remote_url, self.backend_url,
+                                                     self.backend_realm, self.keyfile_path, self.labby)
+
+        # served from the snapshot, until the coordinator session is up
+        self.register("places", places, progressive=True)
+        self.register("list_places", list_places)
+        self.register("resource", resource)
+        self.register("power_state", power_state)
+        self.register("resource_overview", resource_overview, progressive=True)
+        self.register("resource_by_name", resource_by_name)
+        self.register("info", info)
+        self.register("get_reservations", get_reservations)
+        self.register("place_names", places_names)
+        self.register("resource_names", resource_names, progressive=True)
+        self.register("place_resources", place_resources)
+        self.register("resource_places", resource_places)
+        self.register("username", username)
+        self.register("stats", stats)
+        self.register("metrics", metrics)
+        self.register("snapshot", snapshot)
+        self.register("resync", resync)
+        self.register("batch", batch, self.procedures)
 
         # wait unitl labby startup is done
-        while self.labby is None:
+        while self.labby.offline:
             await asyncio.sleep(.5)
 
-        self.register("places", places)
-        self.register("list_places", list_places)
-        self.register("resource", resource)
-        self.register("power_state", power_state)
         self.register("acquire", acquire)
         self.register("release", release)
-        self.register("resource_overview", resource_overview)
-        self.register("resource_by_name", resource_by_name)
-        self.register("info", info)
         self.register("forward", forward)
         self.register("create_place", create_place)
         self.register("delete_place", delete_place)
-        self.register("get_reservations", get_reservations)
         self.register("create_reservation", create_reservation)
         self.register("cancel_reservation", cancel_reservation)
         self.register("poll_reservation", poll_reservation)
         self.register("create_resource", create_resource)
         self.register("delete_resource", delete_resource)
-        self.register("place_names", places_names)
         self.register("get_alias", get_alias)
         self.register("get_exporters", get_exporters)
         self.register("acquire_resource", acquire_resource)
         self.register("release_resource", release_resource)
-        self.register("resource_names", resource_names)
         self.register("add_match", add_match)
         self.register("del_match", del_match)
         self.register("console", console)
@@ -242,7 +485,14 @@ class RouterInterface(ApplicationSession):
         self.register("console_close", console_close)
         self.register("cli_command", cli_command)
         self.register("reset", reset)
-        self.register("username", username)
+        self.subscribe(self.on_session_left, "wamp.session.on_leave")
+
+    def on_session_left(self, session_id: int, *_):
+        """
+        Close the consoles of a frontend session that left, its places are kept
+        """
+        if self.labby is not None and (client := self.labby.clients.leave(session_id)) is not None:
+            self.log.info(f"Frontend session {client.identity} left.")
 
     def onLeave(self, details):
         self.log.info("Session disconnected.")
@@ -250,7 +500,7 @@ class RouterInterface(ApplicationSession):
         frontend_sessions.remove(self)
 
 
-def _start_labby(remote_url, backend_url, backend_realm, keyfile_path, frontend_client):
+def _start_labby(remote_url, backend_url, backend_realm, keyfile_path, labby: LabbyClient):
     """
     run labby and ssh session manager. wait for password if not provided in
     """
@@ -278,9 +528,15 @@ def _start_labby(remote_url, backend_url, backend_realm, keyfile_path, frontend_
         # start ssh session
         labby_runner = ApplicationRunner(backend_url,
                                          realm=backend_realm,
-                                         extra={'frontend': frontend_client,
+                                         extra={'frontend': labby.frontend,
                                                 'ssh_session': ssh_session})
-        labby_coro = labby_runner.run(LabbyClient, start_loop=False)
+
+        def make(config: ComponentConfig) -> LabbyClient:
+            # the session has been created early, to serve the snapshot
+            labby.config = config
+            labby.ssh_session = ssh_session
+            return labby
+        labby_coro = labby_runner.run(make, start_loop=False)
         assert labby_coro is not None
         loop.run_until_complete(labby_coro)
         loop.run_forever()
@@ -12,6 +12,7 @@ class ErrorKind(Enum):
     INVALID_PARAMETER = "InvalidParameter"
     NOT_FOUND = "NotFound"
     FAILED = "Failed"
+    OVERLOADED = "Overloaded"
 
 
 class LabbyError:
@@ -65,3 +66,11 @@ def failed(message: str) -> LabbyError:
     """
     assert message is not None
     return LabbyError(ErrorKind.FAILED, message)
+
+
+def overloaded(message: str) -> LabbyError:
+    """
+    Factory method to instantiate Overloaded Error objects
+    """
+    assert message is not None
+    return LabbyError(ErrorKind.OVERLOADED, message)
@@ -4,13 +4,22 @@ Types used throughout labby
 
 from abc import abstractmethod
 from enum import Enum
-from typing import Any, Dict, List, Optional, Set, Tuple
+from time import perf_counter
+from typing import Any, Dict, List, Set, Tuple
 from autobahn.asyncio.wamp import ApplicationSession
 from attr import attrs, attrib
 
-from labby.cache import Cache, CounterStrategy, PeriodicRefreshStrategy
+from labby.cache import Cache, ResultCache, TTLStrategy
+from labby.clients import Client, Clients
 from labby.console import Console
+from labby.deltas import DeltaLog
+from labby.index import Reservations, ResourceIndex
 from labby.labby_ssh import Session as SSHSession
+from labby.matches import MatchIndex
+from labby.power import PowerStates
+from labby.scheduler import Wakeup
+from labby.stats import StatsRegistry, record_coordinator_time
+from labby.views import PlaceViews
 
 
 TargetName = str
@@ -36,22 +45,67 @@ async def get_resources(context: "Session"):
     return await context.call("org.labgrid.coordinator.get_resources")
 
 
+async def get_reservation_data(context: "Session"):
+    return await context.call("org.labgrid.coordinator.get_reservations")
+
+
 class Session(ApplicationSession):
     """
     Forward declaration for Labby session
     """
 
     def __init__(self, *args, **kwargs) -> None:
-        self.resources: Cache[Resource] = Cache(data=None, refresh_data=get_resources, strategies=[
-            CounterStrategy(5), PeriodicRefreshStrategy(60)])
-        self.places: Cache[Place] = Cache(data=None, refresh_data=get_places, strategies=[  # type: ignore
-            CounterStrategy(5), PeriodicRefreshStrategy(60)])
-        self.acquired_places: Set[PlaceName] = set()
-        self.power_states: Optional[List] = None
-        self.reservations: Dict = {}
+        self.stats = StatsRegistry()
+        # seeded once, then kept current by the coordinator's change events,
+        # see LabbyClient.on_resource_changed and LabbyClient.on_place_changed
+        self.resources: Cache[Resource] = Cache(data=None, refresh_data=get_resources, strategies=[],
+                                                single_flight=True, stale_while_revalidate=True, max_staleness=300.,
+                                                stats=self.stats.cache('resources'))
+        self.places: Cache[Place] = Cache(data=None, refresh_data=get_places, strategies=[],  # type: ignore
+                                          single_flight=True, stale_while_revalidate=True, max_staleness=300.,
+                                          stats=self.stats.cache('places'))
+        # lookups by group, name, class and exporter, kept in sync by on_resource_changed
+        self.resource_index = ResourceIndex()
+        self.resources.on_refresh.append(self.resource_index.rebuild)
+        # results of parameterised queries, invalidated by tag on changes
+        self.results = ResultCache(maxsize=512, ttl=30., stats=self.stats.cache('results'))
+        self.resources.on_refresh.append(lambda _: self.results.clear())
+        self.places.on_refresh.append(lambda _: self.results.clear())
+        self.resources.on_invalidate.append(self.results.clear)
+        self.places.on_invalidate.append(self.results.clear)
+        # place matches resolved to resources, kept current by the change handlers
+        self.matches = MatchIndex()
+        self.resources.on_refresh.append(lambda _: setattr(self.matches, 'dirty', True))
+        self.places.on_refresh.append(lambda _: setattr(self.matches, 'dirty', True))
+        # acquired places and open consoles per frontend session
+        self.clients = Clients()
+        # kept current by the change handlers, rebuilt after full refreshes
+        self.power_states = PowerStates()
+        self.resources.on_refresh.append(lambda _: setattr(self.power_states, 'dirty', True))
+        self.places.on_refresh.append(lambda _: setattr(self.power_states, 'dirty', True))
+        self.reservations = Reservations()
+        # coordinator state of all reservations, shared by all readers for half a second
+        self.reservation_data: Cache[Dict] = Cache(data=None, refresh_data=get_reservation_data,  # type: ignore
+                                                   strategies=[TTLStrategy(0.5)], single_flight=True,
+                                                   stats=self.stats.cache('reservations'))
+        self.reservation_data.on_refresh.append(self.reservations.replace)
+        # what localhost.places serves, kept current by the change handlers
+        self.place_views = PlaceViews()
+        self.resources.on_refresh.append(lambda _: setattr(self.place_views, 'dirty', True))
+        self.places.on_refresh.append(lambda _: setattr(self.place_views, 'dirty', True))
+        self.reservations.on_change.append(
+            lambda place: self.place_views.set_reservation(place, self.reservations.token_for(place)))
+        # versioned patches for clients following a snapshot, reset by full refreshes
+        self.deltas = DeltaLog()
+        self.places.on_refresh.append(lambda _: self.deltas.reset())
+        self.resources.on_refresh.append(lambda _: self.deltas.reset())
+        self.place_views.on_change.append(lambda name, view: self.deltas.append('place', name, view))
         self.to_refresh: Set = set()
+        # wakes refresh_reservations, when tokens are added or a reserved place is freed
+        self.reservation_wakeup = Wakeup()
         self.user_name: str
-        self.open_consoles: Dict[PlaceName, Console] = {}
+        # no coordinator session yet, reads are answered from the snapshot
+        self.offline: bool = False
         self.ssh_session: SSHSession
         self.backend_url: str
         self.backend_realm: str
@@ -59,7 +113,30 @@ class Session(ApplicationSession):
         self.remote_url: str
         super().__init__(*args, **kwargs)
 
+    @property
+    def client(self) -> Client:
+        """
+        Frontend session of the rpc call currently handled
+        """
+        return self.clients.current()
+
+    @property
+    def acquired_places(self) -> Set[PlaceName]:
+        return self.client.acquired_places
+
+    @property
+    def open_consoles(self) -> Dict[PlaceName, Console]:
+        return self.client.open_consoles
 
+    async def call(self, procedure: str, *args, **kwargs):
+        """
+        Call a procedure on the coordinator, accounting the time to the current rpc call
+        """
+        start = perf_counter()
+        try:
+            return await super().call(procedure, *args, **kwargs)
+        finally:
+            record_coordinator_time(perf_counter() - start)
 
 
 class LabbyType:
@@ -0,0 +1,140 @@
+"""
+Resolution of place match patterns (exporter/group/cls/name) to resources
+"""
+
+import re
+from fnmatch import translate
+from typing import Dict, List, Optional, Pattern, Set
+
+from attr import attrs, attrib
+
+from labby.index import ResourceIndex, ResourceKey
+
+PlaceName = str
+Places = Dict[PlaceName, Dict]
+
+_WILDCARDS = re.compile(r'[*?\[]')
+
+
+def _compile(pattern: Optional[str]) -> Optional[Pattern]:
+    if pattern is None:
+        return None
+    return re.compile(translate(pattern))
+
+
+def _literal(pattern: Optional[str]) -> Optional[str]:
+    """
+    the pattern itself, if it matches nothing but itself
+    """
+    if pattern is None or _WILDCARDS.search(pattern):
+        return None
+    return pattern
+
+
+@attrs(frozen=True)
+class ResourceMatch:
+    """
+    Compiled match of a place, a missing name matches any resource name
+    """
+    exporter: str = attrib()
+    group: str = attrib()
+    cls: str = attrib()
+    name: Optional[str] = attrib(default=None)
+    _exporter: Pattern = attrib(init=False, eq=False, repr=False)
+    _group: Pattern = attrib(init=False, eq=False, repr=False)
+    _cls: Pattern = attrib(init=False, eq=False, repr=False)
+    _name: Optional[Pattern] = attrib(init=False, eq=False, repr=False)
+
+    def __attrs_post_init__(self):
+        for field in ('exporter', 'group', 'cls', 'name'):
+            object.__setattr__(self, f"_{field}", _compile(getattr(self, field)))
+
+    @classmethod
+    def from_json(cls, data: Dict) -> "ResourceMatch":
+        return cls(exporter=data.get('exporter') or '*',
+                   group=data.get('group') or '*',
+                   cls=data.get('cls') or '*',
+                   name=data.get('name'))
+
+    def ismatch(self, key: ResourceKey, resource_cls: Optional[str]) -> bool:
+        exporter, group, name = key
+        return (self._exporter.match(exporter) is not None
+                and self._group.match(group) is not None
+                and self._cls.match(resource_cls or '') is not None
+                and (self._name is None or self._name.match(name) is not None))
+
+    def candidates(self, index: ResourceIndex) -> Set[ResourceKey]:
+        """
+        Keys that may match, narrowed down by the literal parts of the match
+        """
+        return index.lookup(exporter=_literal(self.exporter), group=_literal(self.group),
+                            cls=_literal(self.cls), name=_literal(self.name))
+
+
+class MatchIndex:
+    """
+    Resources matched by each place and places using each resource,
+    resolved once and updated for changed places and resources only
+    """
+
+    def __init__(self) -> None:
+        self.matches: Dict[PlaceName, List[ResourceMatch]] = {}
+        self.resources: Dict[PlaceName, Set[ResourceKey]] = {}
+        self.places: Dict[ResourceKey, Set[PlaceName]] = {}
+        # set, when places or resources have been refreshed completely
+        self.dirty: bool = True
+
+    def resources_for(self, place: PlaceName) -> Set[ResourceKey]:
+        return self.resources.get(place, set())
+
+    def places_for(self, key: ResourceKey) -> Set[PlaceName]:
+        return self.places.get(key, set())
+
+    def rebuild(self, places: Optional[Places], index: ResourceIndex):
+        self.matches.clear()
+        self.resources.clear()
+        self.places.clear()
+        for name, data in (places or {}).items():
+            self.update_place(name, data, index)
+        self.dirty = False
+
+    def update_place(self, place: PlaceName, place_data: Optional[Dict], index: ResourceIndex):
+        """
+        Recompile the matches of a place and resolve them, empty data removes the place
+        """
+        for key in self.resources.pop(place, set()):
+            self._unlink(place, key)
+        self.matches.pop(place, None)
+        if not place_data:
+            return
+        matches = [ResourceMatch.from_json(match) for match in place_data.get('matches') or []]
+        self.matches[place] = matches
+        keys = {key for match in matches for key in match.candidates(index)
+                if match.ismatch(key, index.cls(key))}
+        for key in keys:
+            self._link(place, key)
+
+    def update_resource(self, key: ResourceKey, index: ResourceIndex):
+        """
+        Re-evaluate all matches for a single changed resource
+        """
+        for place in self.places.pop(key, set()):
+            self.resources[place].discard(key)
+        if key not in index:
+            return
+        resource_cls = index.cls(key)
+        for place, matches in self.matches.items():
+            if any(match.ismatch(key, resource_cls) for match in matches):
+                self._link(place, key)
+
+    def _link(self, place: PlaceName, key: ResourceKey):
+        self.resources.setdefault(place, set()).add(key)
+        self.places.setdefault(key, set()).add(place)
+
+    def _unlink(self, place: PlaceName, key: ResourceKey):
+        places = self.places.get(key)
+        if places is not None:
+            places.discard(place)
+            if not places:
+                del self.places[key]
+
@@ -0,0 +1,72 @@
+"""
+Incrementally maintained power states of places
+"""
+
+from typing import Dict, Iterable, Optional
+
+PlaceName = str
+Places = Dict[PlaceName, Dict]
+Resources = Dict[str, Dict[str, Dict[str, Dict]]]
+
+
+def _calc_power_for_place(place_name: PlaceName, resources: Iterable[Dict]) -> bool:
+    pstate = False
+    for res in resources:
+        if isinstance(res['acquired'], Iterable):
+            pstate |= place_name in res['acquired']
+        else:
+            pstate |= res['acquired'] == place_name
+    return pstate
+
+
+def calc_power_state(place_name: PlaceName, place_data: Dict, resources: Resources) -> bool:
+    """
+    A place is powered, if one of its acquired resources has been acquired for the place.
+    Only resources in the group named after the place are considered.
+    """
+    acquired = place_data.get('acquired_resources') or []
+    if len(acquired) == 0:
+        return False
+    group = {name: data
+             for exporter_data in resources.values()
+             for name, data in exporter_data.get(place_name, {}).items() if data}
+    resources_to_check = (data for name, data in group.items()
+                          if any(name in a for a in acquired))
+    return _calc_power_for_place(place_name, resources_to_check)
+
+
+class PowerStates:
+    """
+    Power state per place, recomputed only for places affected by a change
+    """
+
+    def __init__(self) -> None:
+        self.states: Dict[PlaceName, bool] = {}
+        # set, when places or resources have been refreshed completely
+        self.dirty: bool = True
+
+    def rebuild(self, places: Places, resources: Resources):
+        self.states = {name: calc_power_state(name, data, resources)
+                       for name, data in places.items()
+                       if data and 'acquired_resources' in data}
+        self.dirty = False
+
+    def update(self, place_name: PlaceName, places: Optional[Places], resources: Optional[Resources]) -> Optional[bool]:
+        """
+        Recompute the power state of a single place.
+        Returns the new state if it flipped, None otherwise.
+        """
+        if self.dirty or places is None or resources is None:
+            return None
+        place_data = places.get(place_name)
+        old = self.states.get(place_name)
+        if not place_data or 'acquired_resources' not in place_data:
+            self.states.pop(place_name, None)
+            return None
+        new = calc_power_state(place_name, place_data, resources)
+        self.states[place_name] = new
+        return new if new != bool(old) else None
+
+    def to_json(self, place: Optional[PlaceName] = None):
+        return {name: {'power_state': state} for name, state in self.states.items()
+                if place is None or name == place}
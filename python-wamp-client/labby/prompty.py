@@ -22,8 +22,8 @@ class Component(ApplicationSession):
         globals()["session"] = self
 
     async def onJoin(self, details):
-        await self.subscribe(lambda x: print(f"onResourceChanged got: {x}"), "localhost.onResourceChanged")
-        await self.subscribe(lambda x: print(f"onPlaceChanged    got: {x}"), "localhost.onPlaceChanged")
+        await self.subscribe(lambda x: print(f"onResourcesChanged got: {x}"), "localhost.onResourcesChanged")
+        await self.subscribe(lambda x: print(f"onPlacesChanged    got: {x}"), "localhost.onPlacesChanged")
 
     def onDisconnect(self):
         asyncio.get_event_loop().stop()
@@ -0,0 +1,115 @@
+"""
+Coalescing of change events published to the frontend
+"""
+
+import asyncio
+import asyncio.log
+import re
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional
+
+from labby.scheduler import ScheduledCall, Scheduler, get_scheduler
+
+# not allowed in a component of a WAMP URI
+_INVALID_URI_CHARS = re.compile(r'[.#\s]')
+
+
+def topic_component(name: str) -> str:
+    return _INVALID_URI_CHARS.sub('_', str(name)) or '_'
+
+
+# Scoped topics, subscribe with prefix or wildcard matching for several,
+# e.g. prefix 'localhost.resources.exporter1.' for all groups of an exporter
+
+def place_topic(place: str) -> str:
+    return f"localhost.places.{topic_component(place)}.changed"
+
+
+def resource_topic(exporter: str, group: str) -> str:
+    return f"localhost.resources.{topic_component(exporter)}.{topic_component(group)}.changed"
+
+
+def power_topic(place: str) -> str:
+    return f"localhost.power.{topic_component(place)}"
+
+
+def _running_loop() -> Optional[asyncio.AbstractEventLoop]:
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+class EventCoalescer:
+    """
+    Collects events per topic and key and publishes them as one list per topic.
+    A newer event for the same key replaces the pending one and moves it to the end,
+    so every list is ordered by the last change. Events are flushed once no new event
+    arrived for window seconds, but at most max_latency seconds after the first one.
+    Topics are published in the order of their first pending event.
+    Events added from another thread are handed over to loop, if it is set.
+    """
+
+    def __init__(self, publish: Callable[[str, List], Any], window: float = 0.05,
+                 max_latency: float = 0.25, scheduler: Optional[Scheduler] = None,
+                 loop: Optional[asyncio.AbstractEventLoop] = None) -> None:
+        self.publish = publish
+        self.window = window
+        self.max_latency = max_latency
+        self.loop = loop
+        self._scheduler = scheduler
+        self._pending: Dict[str, "OrderedDict[Hashable, Any]"] = {}
+        self._first: Optional[float] = None
+        self._last: float = 0.
+        self._flush_call: Optional[ScheduledCall] = None
+
+    def __len__(self) -> int:
+        return sum(len(events) for events in self._pending.values())
+
+    def add(self, topic: str, key: Hashable, payload: Any):
+        if self.loop is not None and self.loop is not _running_loop():
+            # e.g. reservation changes seen by the frontend router
+            self.loop.call_soon_threadsafe(self._add, topic, key, payload)
+        else:
+            self._add(topic, key, payload)
+
+    def _add(self, topic: str, key: Hashable, payload: Any):
+        events = self._pending.setdefault(topic, OrderedDict())
+        events.pop(key, None)
+        events[key] = payload
+        scheduler = self._scheduler or get_scheduler(self.loop or asyncio.get_event_loop())
+        self._last = scheduler.loop.time()
+        if self._first is None:
+            self._first = self._last
+        if self._flush_call is None:
+            # the timer is only moved when it fires, not on every event
+            self._flush_call = scheduler.call_at(self._deadline(), self._on_timer, scheduler)
+
+    def flush(self):
+        """
+        Publish all pending events now
+        """
+        if self._flush_call is not None:
+            self._flush_call.cancel()
+            self._flush_call = None
+        pending, self._pending = self._pending, {}
+        self._first = None
+        for topic, events in pending.items():
+            try:
+                self.publish(topic, list(events.values()))
+            except Exception:  # pylint: disable=broad-except
+                # the other topics are still published
+                asyncio.log.logger.exception(f"Could not publish events on {topic}.")
+
+    def _deadline(self) -> float:
+        assert self._first is not None
+        return min(self._last + self.window, self._first + self.max_latency)
+
+    def _on_timer(self, scheduler: Scheduler):
+        self._flush_call = None
+        if self._first is None:
+            return
+        if (deadline := self._deadline()) > scheduler.loop.time():
+            self._flush_call = scheduler.call_at(deadline, self._on_timer, scheduler)
+        else:
+            self.flush()
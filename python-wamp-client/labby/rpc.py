@@ -4,15 +4,21 @@ Generic RPC functions for labby
 
 # import asyncio
 import asyncio
+import asyncio.log
 from cgi import print_exception
+import inspect
 import os
+from itertools import islice
 from pathlib import Path
-from typing import Any, Callable, Dict, Iterable, List, Optional, Type, Union
+from time import perf_counter, time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Type, Union
 
 import yaml
 from attr import attrib, attrs
 from autobahn.wamp.exception import ApplicationError
+from labby.cache import MISSING
 from labby.console import Console
+from labby.index import ResourceKey
 
 from labby.resource import LabbyResource, NetworkSerialPort, PowerAction, power_resources, power_resource_from_name
 
@@ -21,6 +27,7 @@ from .labby_error import (LabbyError, failed, invalid_parameter,
 from .labby_types import (ExporterName, GroupName, LabbyPlace, PlaceName, PowerState, Resource,
                           ResourceName, Session, Place)
 from .labby_util import flatten
+from .scheduler import get_scheduler
 
 
 def _check_not_none(*args, **kwargs) -> Optional[LabbyError]:
@@ -47,6 +54,26 @@ with open(_localfile('rpc_desc.yaml'), 'r', encoding='utf-8') as file:
                                                                    yaml.loader.FullLoader).items() if val is not None}
 
 
+# close consoles that have not been written to or read from for this many seconds, None to keep them open
+CONSOLE_IDLE_TIMEOUT: Optional[float] = None
+
+# bounds in seconds for polling waiting reservations
+RESERVATION_POLL_MIN = 1.
+RESERVATION_POLL_MAX = 10.
+# coordinator calls refreshing reservations in parallel, and seconds until each of them is given up
+RESERVATION_CONCURRENCY = 8
+RESERVATION_CALL_TIMEOUT = 5.
+
+# number of entries per progressive result
+PROGRESS_CHUNK_SIZE = 100
+
+# endpoints, which do not change any state and may run concurrently in a batch
+READ_ONLY_ENDPOINTS = {
+    "places", "list_places", "resource", "power_state", "resource_overview", "resource_by_name",
+    "info", "get_reservations", "place_names", "get_alias", "get_exporters", "resource_names",
+    "place_resources", "resource_places", "stats", "username", "snapshot", "resync", "metrics",
+}
+
 # non exhaustive list of serializable primitive types
 _serializable_primitive: List[Type] = [int, float, str, bool]
 
@@ -73,6 +100,7 @@ def cached(attribute: str):
 
         async def wrapped(context: Session, *args, **kwargs):
             assert context is not None
+            cache_stats = context.stats.cache(attribute)
 
             if not hasattr(context, attribute):
                 context.__dict__.update({attribute: None})
@@ -81,9 +109,16 @@ def cached(attribute: str):
                 data: Optional[Dict] = context.__getattribute__(
                     attribute)
             if data is None:
+                cache_stats.misses += 1
+                start = perf_counter()
                 data: Optional[Dict] = await func(context, *args, **kwargs)
-                if not isinstance(data, LabbyError):
+                if isinstance(data, LabbyError):
+                    cache_stats.refresh_errors += 1
+                else:
+                    cache_stats.refreshed(perf_counter() - start, data)
                     context.__setattr__(attribute, data)
+            else:
+                cache_stats.hits += 1
             return data
 
         return wrapped
@@ -91,6 +126,43 @@ def cached(attribute: str):
     return decorator
 
 
+def memoized(tags: Callable[..., Iterable[str]]):
+    """
+    Decorator to keep results of parameterised queries in context.results.
+    tags is called with the query's arguments and returns the tags
+    under which the result is invalidated, see LabbyClient.on_resource_changed
+    """
+    def decorator(func: Callable):
+        signature = inspect.signature(func)
+
+        async def wrapped(context: Session, *args, **kwargs):
+            params = signature.bind(context, *args, **kwargs)
+            params.apply_defaults()
+            arguments = dict(params.arguments)
+            del arguments['context']
+            key = (func.__name__, *arguments.items())
+            try:
+                hash(key)
+            except TypeError:
+                # e.g. a list passed by the caller, such queries are not cached
+                return await func(context, *args, **kwargs)
+            ret = context.results.get(key)
+            if ret is not MISSING:
+                return ret
+            ret = await func(context, *args, **kwargs)
+            if not isinstance(ret, LabbyError):
+                context.results.put(key, ret, tags(**arguments))
+            return ret
+
+        return wrapped
+
+    return decorator
+
+
+def _resource_tags(place: Optional[PlaceName] = None, **_) -> List[str]:
+    return [f"group:{place}"] if place is not None else ["resources"]
+
+
 def labby_serialized(func):
     """
     Custom serializer decorator for labby rpc functions
@@ -120,10 +192,16 @@ async def fetch(context: Session, attribute: str, endpoint: str, *args, **kwargs
     assert attribute is not None
     assert endpoint is not None
 
+    cache_stats = context.stats.cache(attribute)
     data: Optional[Dict] = getattr(context, attribute)
     if data is None:
+        cache_stats.misses += 1
+        start = perf_counter()
         data: Optional[Dict] = await context.call(endpoint, *args, **kwargs)
+        cache_stats.refreshed(perf_counter() - start, data)
         setattr(context, attribute, data)
+    else:
+        cache_stats.hits += 1
     return data
 
 
@@ -159,26 +237,46 @@ async def fetch_resources(context: Session,
             return not_found("Could not find any resources.")
         return not_found(f"No resources found for place {place}.")
 
-    if place is not None:
-        data = {exporter: {k: v for k, v in exporter_data.items() if k == place and v}
-                for exporter, exporter_data in data.items()}
-
-    if resource_key is not None:
-        data = {exporter:
-                {place_name:
-                    {k: v for k, v in place_res.items() if k == resource_key if v}
-                    for place_name, place_res in exporter_data.items() if place_res}
-                for exporter, exporter_data in data.items()}
-    return data
+    if place is None and resource_key is None:
+        return data
+    return await _filter_resources(context, place, resource_key)
+
+
+@memoized(_resource_tags)
+async def _filter_resources(context: Session,
+                            place: Optional[PlaceName],
+                            resource_key: Optional[ResourceName]) -> Dict:
+    ret: Dict = {}
+    for (exporter, group, name), values in _resource_entries(
+            context, context.resource_index.lookup(group=place, name=resource_key)):
+        ret.setdefault(exporter, {}).setdefault(group, {})[name] = values
+    return ret
+
+
+def _resource_entries(context: Session, keys: Iterable[ResourceKey]) -> Iterator[Tuple[ResourceKey, Resource]]:
+    """
+    Resolve resource index keys to resource data, ordered by key
+    """
+    data = context.resources.get_soft() or {}
+    for key in sorted(keys):
+        exporter, group, name = key
+        if values := data.get(exporter, {}).get(group, {}).get(name):
+            yield key, values
 
 
 @cached("peers")
 async def fetch_peers(context: Session) -> Union[Dict, LabbyError]:
+    """
+    Fetch the details of all sessions on the coordinator, keyed by authid.
+    Kept current afterwards by LabbyClient.on_peer_joined and on_peer_left.
+    """
     session_ids = await context.call("wamp.session.list")
+    details = await asyncio.gather(*(context.call("wamp.session.get", sess) for sess in session_ids),
+                                   return_exceptions=True)
     sessions = {}
-    for sess in session_ids:  # ['exact']:
-        tmp = await context.call("wamp.session.get", sess)
-        if tmp and 'authid' in tmp:
+    for tmp in details:
+        # sessions may have left in the meantime
+        if isinstance(tmp, dict) and 'authid' in tmp:
             sessions[tmp['authid']] = tmp
     return sessions
 
@@ -191,90 +289,132 @@ async def get_exporters(context: Session) -> Union[List[ExporterName], LabbyErro
     return [x.replace('exporter/', '') for x in peers if x.startswith('exporter')]
 
 
-def _calc_power_for_place(place_name, resources: Iterable[Dict]):
-    pstate = False
-    for res in resources:
-        if isinstance(res['acquired'], Iterable):
-            pstate |= place_name in res['acquired']
-        else:
-            pstate |= res['acquired'] == place_name
-    return pstate
-
-
-@cached("power_states")
 async def fetch_power_state(context: Session,
                             place: Optional[PlaceName]) -> Union[PowerState, LabbyError]:
     """
-    Use fetch resource to determine power state, this may update context.resource
+    Return power states from context.power_states, this may update context.resource.
+    Power states are only recomputed completely after places or resources have been refreshed.
     """
-
-    _resources = await fetch_resources(context=context, place=place, resource_key=None)
+    _resources = await fetch_resources(context=context, place=None, resource_key=None)
     if isinstance(_resources, LabbyError):
         return _resources
-    if len(_resources) > 0:
-        _resources = flatten(_resources)
     _places = await fetch_places(context, place)
     if isinstance(_places, LabbyError):
         return _places
-    power_states = {}
-    assert _places
-    for place_name, place_data in _places.items():
-        if 'acquired_resources' in place_data:
-            if len(place_data['acquired_resources']) == 0 or place_name not in _resources:
-                power_states[place_name] = {'power_state': False}
-                continue
-            resources_to_check = ((v for k, v in _resources[place_name].items() if any(
-                (k in a for a in place_data['acquired_resources']))))
-            power_states[place_name] = {
-                'power_state': _calc_power_for_place(place_name, resources_to_check)}
-    return power_states
+    cache_stats = context.stats.cache('power_states')
+    if context.power_states.dirty:
+        cache_stats.misses += 1
+        start = perf_counter()
+        context.power_states.rebuild(context.places.get_soft(), context.resources.get_soft())
+        cache_stats.refreshed(perf_counter() - start, context.power_states.states)
+    else:
+        cache_stats.hits += 1
+    return context.power_states.to_json(place)
+
+
+async def paginate(items: Iterable, cursor: int = 0, limit: Optional[int] = None,
+                   progress: Optional[Callable[[List], None]] = None) -> Union[List, LabbyError]:
+    """
+    Return limit items starting at cursor. If progress is given, full chunks
+    of PROGRESS_CHUNK_SIZE items are sent as progressive results while they are
+    produced and only the last chunk is returned.
+    """
+    cursor = cursor or 0
+    if not isinstance(cursor, int) or cursor < 0:
+        return invalid_parameter("Cursor must be a non negative integer.")
+    if limit is not None and (not isinstance(limit, int) or limit < 0):
+        return invalid_parameter("Limit must be a non negative integer.")
+    chunk: List = []
+    for item in islice(items, cursor, None if limit is None else cursor + limit):
+        chunk.append(item)
+        if progress is not None and len(chunk) == PROGRESS_CHUNK_SIZE:
+            progress(chunk)
+            chunk = []
+            await asyncio.sleep(0)  # let others run between chunks
+    return chunk
+
+
+def _matches_value(actual: Any, wanted: Any) -> bool:
+    """
+    bool filters test whether a value is set, all others test for equality
+    """
+    if isinstance(wanted, bool):
+        return bool(actual) == wanted
+    return actual == wanted
+
+
+def _select(entries: Iterable[Dict], predicates: List[Callable[[Dict], bool]],
+            fields: Optional[List[str]]) -> Iterator[Dict]:
+    """
+    Entries matching all predicates, reduced to name and fields if given
+    """
+    for entry in entries:
+        if all(predicate(entry) for predicate in predicates):
+            yield entry if fields is None else {key: entry[key] for key in ('name', *fields) if key in entry}
+
+
+def _check_fields(fields: Any) -> Optional[LabbyError]:
+    if fields is not None and (not isinstance(fields, list) or not all(isinstance(field, str) for field in fields)):
+        return invalid_parameter("Fields must be a list of field names.")
+    return None
 
 
 @labby_serialized
 async def places(context: Session,
-                 place: Optional[PlaceName] = None) -> Union[List[LabbyPlace], LabbyError]:
+                 place: Optional[PlaceName] = None,
+                 cursor: int = 0,
+                 limit: Optional[int] = None,
+                 fields: Optional[List[str]] = None,
+                 exporter: Optional[ExporterName] = None,
+                 acquired: Union[None, bool, str] = None,
+                 power_state: Optional[bool] = None,
+                 available: Optional[bool] = None,
+                 *,
+                 progress: Optional[Callable[[List], None]] = None) -> Union[List[LabbyPlace], LabbyError]:
     """
-    returns registered places as dict of lists
+    returns registered places as dict of lists,
+    optionally filtered and reduced to the given fields
     """
     context.log.info("Fetching places.")
+    if err := _check_fields(fields):
+        return err
 
     data = await fetch_places(context, place)
     if isinstance(data, LabbyError):
         return data
+    # served from a snapshot, while the coordinator data is loading
+    stale = context.places.stale
     power_states = await fetch_power_state(context=context, place=place)
     assert power_states is not None
     if isinstance(power_states, LabbyError):
         return power_states
     await get_reservations(context)
 
-    def token_from_place(name):
-        return next((token for token, x in context.reservations.items()
-                     if x['filters']['main']['name'] == name), None)
-    place_res = []
-    assert data
-    for place_name, place_data in data.items():
-        # append the place to acquired places if
-        # it has been acquired in a previous session
-        if (place_data and place_data['acquired'] == context.user_name
-                and place_name not in context.acquired_places
-                ):
-            context.acquired_places.add(place_name)
-        if place is not None and place_name != place:
-            continue
-        # ??? (Kevin) what if there are more than one or no matches
-        if len(place_data["matches"]) > 0 and 'exporter' in place_data["matches"]:
-            exporter = place_data["matches"][0]["exporter"]
-        else:
-            exporter = None
-
-        place_data.update({
-            "name": place_name,
-            "exporter": exporter,
-            "power_state": power_states.get(place_name, {}).get('power_state', None),
-            "reservation": token_from_place(place_name)
-        })
-        place_res.append(place_data)
-    return place_res
+    if context.place_views.dirty:
+        all_places = context.places.get_soft() or {}
+        for place_name, place_data in all_places.items():
+            # keep the place, if it has been acquired in a previous session
+            if place_data:
+                context.clients.sync(place_name, place_data['acquired'] == context.user_name)
+        context.place_views.rebuild(all_places, context.power_states.states.get,
+                                    context.reservations.token_for, stale)
+    views = context.place_views.to_list(place)
+    predicates: List[Callable[[Dict], bool]] = []
+    if exporter is not None:
+        if err := await fetch_matches(context):
+            return err
+        predicates.append(lambda view: any(key[0] == exporter
+                                           for key in context.matches.resources_for(view['name'])))
+    if acquired is not None:
+        predicates.append(lambda view: _matches_value(view.get('acquired'), acquired))
+    if power_state is not None:
+        predicates.append(lambda view: bool(view.get('power_state')) == power_state)
+    if available is not None:
+        predicates.append(lambda view: (view.get('acquired') is None
+                                        and view.get('reservation') is None) == available)
+    if not cursor and limit is None and progress is None and fields is None and not predicates:
+        return views
+    return await paginate(_select(views, predicates, fields), cursor, limit, progress)
 
 
 @labby_serialized
@@ -327,29 +467,58 @@ async def power_state(context: Session,
     return power_data[place]
 
 
+@memoized(_resource_tags)
+async def _resource_overview(context: Session,
+                             place: Optional[PlaceName] = None,
+                             ) -> Union[List[Resource], LabbyError]:
+    context.log.info(f"Fetching resources overview for {place}.")
+
+    targets = await fetch_resources(context=context, place=None, resource_key=None)
+    if isinstance(targets, LabbyError):
+        return targets
+
+    return [{'name': name, 'target': exporter, 'place': group, **values}
+            for (exporter, group, name), values in _resource_entries(
+                context, context.resource_index.lookup(group=place))]
+
+
 @labby_serialized
 async def resource_overview(context: Session,
                             place: Optional[PlaceName] = None,
+                            cursor: int = 0,
+                            limit: Optional[int] = None,
+                            fields: Optional[List[str]] = None,
+                            exporter: Optional[ExporterName] = None,
+                            cls: Optional[str] = None,
+                            acquired: Union[None, bool, str] = None,
+                            available: Optional[bool] = None,
+                            *,
+                            progress: Optional[Callable[[List], None]] = None,
                             ) -> Union[List[Resource], LabbyError]:
     """
-    rpc: returns list of all resources on target
+    rpc: returns list of all resources on target,
+    optionally filtered and reduced to the given fields
     """
-    context.log.info(f"Fetching resources overview for {place}.")
-
-    targets = await fetch_resources(context=context, place=place, resource_key=None)
-    if isinstance(targets, LabbyError):
-        return targets
-
-    ret = []
-    for exporter, resources in targets.items():
-        for res_place, res in resources.items():
-            if place is None or place == res_place:
-                ret.extend({'name': key, 'target': exporter,
-                            'place': res_place, **values} for key, values in res.items())
-    return ret
+    if err := _check_fields(fields):
+        return err
+    overview = await _resource_overview(context, place)
+    predicates: List[Callable[[Dict], bool]] = []
+    if exporter is not None:
+        predicates.append(lambda entry: entry['target'] == exporter)
+    if cls is not None:
+        predicates.append(lambda entry: entry.get('cls') == cls)
+    if acquired is not None:
+        predicates.append(lambda entry: _matches_value(entry.get('acquired'), acquired))
+    if available is not None:
+        predicates.append(lambda entry: bool(entry.get('avail')) == available)
+    if isinstance(overview, LabbyError) or (not cursor and limit is None and progress is None
+                                            and fields is None and not predicates):
+        return overview
+    return await paginate(_select(overview, predicates, fields), cursor, limit, progress)
 
 
 @labby_serialized
+@memoized(lambda name: [f"name:{name}"])
 async def resource_by_name(context: Session,
                            name: ResourceName,  # filter by name
                            ) -> Union[List[Resource], LabbyError]:
@@ -359,36 +528,36 @@ async def resource_by_name(context: Session,
 
     if name is None:
         return invalid_parameter("Missing required parameter: name.")
+    if not isinstance(name, str):
+        return invalid_parameter("Name must be a resource name.")
 
     resource_data = await fetch_resources(context, place=None, resource_key=None)
     if isinstance(resource_data, LabbyError):
         return resource_data
 
-    ret = []
-    for target, resources in resource_data.items():
-        for place, res in resources.items():
-            ret.extend(
-                {'name': key, 'target': target, 'place': place, **values}
-                for key, values in res.items()
-                if name == key
-            )
-
-    return ret
+    return [{'name': key, 'target': target, 'place': place, **values}
+            for (target, place, key), values in _resource_entries(
+                context, context.resource_index.lookup(name=name))]
 
 
 @labby_serialized
-async def resource_names(context: Session) -> List[Dict[str, str]]:
+async def resource_names(context: Session,
+                         cursor: int = 0,
+                         limit: Optional[int] = None,
+                         *,
+                         progress: Optional[Callable[[List], None]] = None,
+                         ) -> Union[List[Dict[str, str]], LabbyError]:
     await fetch_resources(context, None, None)
-    data = context.resources or {}
-    def it(x): return x.items()
-    return [
+    index = context.resource_index
+    # entries are produced while paginating
+    return await paginate((
         {'exporter': exporter,
          'group': grp_name,
-         'class': x.get('cls'),
+         'class': index.cls(key),
          'name': name,
          }
-        for exporter, group in it(data) for grp_name, res in it(group) for name, x in it(res)
-    ]
+        for key in sorted(index.keys()) for exporter, grp_name, name in (key,)
+    ), cursor, limit, progress)
 
 
 @labby_serialized
@@ -401,6 +570,12 @@ async def acquire(context: Session,
         return invalid_parameter("Missing required parameter: place.")
     if place in context.acquired_places:
         return failed(f"Already acquired place {place}.")
+    if (holder := context.clients.holder(place)) is context.clients.default:
+        # acquired by a session that is gone, adopt it
+        context.clients.hold(context.client, place)
+        return True
+    if holder is not None:
+        return failed(f"Place {place} is acquired by {holder.identity}.")
 
     # , group, resource_key, place)
     context.log.info(f"Acquiring place {place}.")
@@ -409,14 +584,14 @@ async def acquire(context: Session,
     except ApplicationError as err:
         return failed(f"Got exception while trying to call org.labgrid.coordinator.acquire_place. {err}")
     if acquire_successful:
-        context.acquired_places.add(place)
+        context.clients.hold(context.client, place)
         # remove the reservation if there was one
-        if token := next((token for token, x in context.reservations.items() if x['filters']['main']['name'] == place), None,):
+        if token := context.reservations.token_for(place):
             ret = await cancel_reservation(context, token)
             if isinstance(ret, LabbyError):
                 # context.log.error(f"Could not cancel reservation after acquire: {ret}")
                 print(f"Could not cancel reservation after acquire: {ret}")
-            del context.reservations[token]
+            context.reservations.pop(token, None)
     return acquire_successful
 
 
@@ -454,15 +629,19 @@ async def info(_context=None, func_key: Optional[str] = None) -> Union[List[Dict
 
 async def get_reservations(context: Session) -> Dict:
     """
-    RPC call to list current reservations on the Coordinator
+    RPC call to list current reservations on the Coordinator,
+    answered from context.reservation_data, if it has just been refreshed
     """
-    reservation_data: Dict = await context.call("org.labgrid.coordinator.get_reservations")
+    if context.offline:
+        return dict(context.reservations)
+    reservation_data: Dict = await context.reservation_data.get(context) or {}
 
     for token, data in reservation_data.items():
         if (data['state'] in ('waiting', 'allocated', 'acquired')
-                and data['owner'] == context.user_name):
+                and data['owner'] == context.user_name
+                and token not in context.to_refresh):
             context.to_refresh.add(token)
-    context.reservations.update(**reservation_data)
+            context.reservation_wakeup.set()
     return reservation_data
 
 
@@ -473,7 +652,8 @@ async def create_reservation(context: Session, place: PlaceName, priority: float
     if place is None:
         return invalid_parameter("Missing required parameter: place.")
     await get_reservations(context)  # get current state from coordinator
-    if any((place == x['filters']['main']['name'] for x in context.reservations.values() if 'name' in x['filters']['main'] and x['state'] not in ('expired', 'invalid'))):
+    if any(context.reservations[token]['state'] not in ('expired', 'invalid')
+           for token in context.reservations.tokens_for(place)):
         return failed(f"Place {place} is already reserved.")
     reservation = await context.call("org.labgrid.coordinator.create_reservation",
                                      f"name={place}",
@@ -481,42 +661,124 @@ async def create_reservation(context: Session, place: PlaceName, priority: float
     if not reservation:
         return failed("Failed to create reservation")
     context.reservations.update(reservation)
-    context.to_refresh.add((next(iter(reservation.keys()))))
+    token = next(iter(reservation.keys()))
+    context.clients.reserved_by[token] = context.client
+    context.to_refresh.add(token)
+    context.reservation_wakeup.set()
     return reservation
 
 
-async def refresh_reservations(context: Session):
+def _next_poll_delay(delay: float, reservation: Dict) -> float:
+    """
+    Back off exponentially, but poll before the reservation times out
+    """
+    delay = min(delay * 2, RESERVATION_POLL_MAX)
+    if timeout := reservation.get('timeout'):
+        delay = min(delay, max(RESERVATION_POLL_MIN, (timeout - time()) / 2))
+    return delay
+
+
+async def refresh_reservations(context: Session,
+                               concurrency: int = RESERVATION_CONCURRENCY,
+                               call_timeout: float = RESERVATION_CALL_TIMEOUT):
+    """
+    Keep the reservations in context.to_refresh alive and acquire their places, once allocated.
+    Sleeps while there is nothing to refresh, waiting tokens are polled with an increasing delay.
+    Polls and acquisitions run concurrently, at most concurrency at a time and each
+    limited to call_timeout seconds.
+    """
+    loop = asyncio.get_event_loop()
+    limit = asyncio.Semaphore(concurrency)
+    delays: Dict[str, float] = {}  # token -> current poll delay
+    due: Dict[str, float] = {}  # token -> loop time of the next poll
+    to_remove: Set[str] = set()
+
+    async def _limited(token: str, coro):
+        # a failing token is retried on the next cycle, it must not stop the others
+        async with limit:
+            try:
+                return await asyncio.wait_for(coro, call_timeout)
+            except asyncio.TimeoutError:
+                context.log.error(f"Timed out refreshing reservation {token}.")
+            except Exception as err:  # pylint: disable=broad-except
+                # the error's repr may contain braces, let the logger format it
+                context.log.error("Failed to refresh reservation {token}: {err}", token=token, err=err)
+            return None
+
+    async def _poll(token: str, reservation: Dict):
+        ret = await _limited(token, context.call("org.labgrid.coordinator.poll_reservation", token))
+        if not ret:
+            context.log.error(
+                f"Failed to poll reservation {token}.")
+            delays.pop(token, None)  # retry soon
+        else:
+            context.reservations[token] = ret
+            delays[token] = _next_poll_delay(delays.get(token, RESERVATION_POLL_MIN / 2), reservation)
+        due[token] = loop.time() + delays.get(token, RESERVATION_POLL_MIN)
+
+    async def _acquire(token: str, place_name: PlaceName):
+        async def _acquire_and_cancel():
+            ret = await acquire(context, place_name)
+            await cancel_reservation(context, place_name)
+            return ret
+        # acquired for the session that made the reservation
+        with context.clients.use(context.clients.for_token(token)):
+            ret = await _limited(token, _acquire_and_cancel())
+        if ret is None:
+            # failed or timed out, retry with the next cycle
+            due[token] = loop.time() + RESERVATION_POLL_MIN
+            return
+        if not ret:
+            context.log.error(
+                f"Could not acquire reserved place {token}: {place_name}")
+        to_remove.add(token)
+
     while True:
-        to_remove = set()
-        context.reservations = await context.call("org.labgrid.coordinator.get_reservations")
-        for token in context.to_refresh:
+        if not context.to_refresh:
+            delays.clear()
+            due.clear()
+            await context.reservation_wakeup.wait()
+            continue
+        to_remove.clear()
+        try:
+            await context.reservation_data.get(context)
+        except Exception as err:  # pylint: disable=broad-except
+            context.log.error("Failed to fetch reservations: {err}", err=err)
+            await context.reservation_wakeup.wait(RESERVATION_POLL_MIN)
+            continue
+        now = loop.time()
+        pending = []
+        for token in list(context.to_refresh):
             if token in context.reservations:
                 # context.log.info(f"Refreshing reservation {token}")
-                state = context.reservations[token]['state']
-                place_name = context.reservations[token]['filters']['main']['name']
+                reservation = context.reservations[token]
+                state = reservation['state']
+                place_name = reservation['filters']['main']['name']
                 if state == 'waiting':
-                    ret = await context.call("org.labgrid.coordinator.poll_reservation", token)
-                    if not ret:
-                        context.log.error(
-                            f"Failed to poll reservation {token}.")
-                    context.reservations[token] = ret
+                    if due.get(token, now) <= now:
+                        pending.append(_poll(token, reservation))
                 # acquire the resource, when it has been allocated by the coordinator
-                elif (context.reservations[token]['state'] == 'allocated'
-                      or (context.reservations[token]['state'] == 'acquired' and place_name not in context.acquired_places)
+                elif (state == 'allocated'
+                      or (state == 'acquired'
+                          and place_name not in context.clients.for_token(token).acquired_places)
                       ):
-                    ret = await acquire(context, place_name)
-                    await cancel_reservation(context, place_name)
-                    if not ret:
-                        context.log.error(
-                            f"Could not acquire reserved place {token}: {place_name}")
-                    to_remove.add(token)
+                    if due.get(token, now) <= now:
+                        pending.append(_acquire(token, place_name))
                 else:
                     to_remove.add(token)
             else:
                 to_remove.add(token)
+        for err in await asyncio.gather(*pending, return_exceptions=True):
+            if isinstance(err, Exception):
+                context.log.error("Failed to refresh reservations: {err}", err=err)
         for token in to_remove:
-            context.to_refresh.remove(token)
-        await asyncio.sleep(1.)  # !! TODO set to 10s
+            context.to_refresh.discard(token)
+            context.clients.reserved_by.pop(token, None)
+            delays.pop(token, None)
+            due.pop(token, None)
+        if context.to_refresh:
+            next_due = min(due.get(token, now) for token in context.to_refresh)
+            await context.reservation_wakeup.wait(max(next_due - loop.time(), 0.))
 
 
 @labby_serialized
@@ -524,8 +786,7 @@ async def cancel_reservation(context: Session, place: PlaceName) -> Union[bool,
     if place is None:
         return invalid_parameter("Missing required parameter: place.")
     await get_reservations(context)  # get current state from coordinator
-    token = next((token for token, x in context.reservations.items()
-                 if x['filters']['main']['name'] == place), None)
+    token = context.reservations.token_for(place)
     if token is None:
         return failed(f"No reservations available for place {place}.")
     del context.reservations[token]
@@ -536,8 +797,7 @@ async def cancel_reservation(context: Session, place: PlaceName) -> Union[bool,
 async def poll_reservation(context: Session, place: PlaceName) -> Union[Dict, LabbyError]:
     if place is None:
         return invalid_parameter("Missing required parameter: place.")
-    token = next((token for token, x in context.reservations.items()
-                 if x['filters']['main']['name'] == place), None)
+    token = context.reservations.token_for(place)
     if token is None:
         return failed(f"No reservations available for place {place}.")
     if not token:
@@ -566,11 +826,10 @@ async def reset(context: Session, place: PlaceName) -> Union[bool, LabbyError]:
         if not acq:
             return failed(f"Could not acquire place {place}.")
 
-    res = await fetch_resources(context, place, None)
+    res = await fetch_resources(context, None, None)
     if isinstance(res, LabbyError):
         return failed(f"Failed to get resources for place {place}.")
-    res = flatten(res, 2)  # remove exporter and group from res
-    for resname, resdata in res.items():
+    for (_, _, resname), resdata in _resource_entries(context, context.resource_index.lookup(group=place)):
         if resname in power_resources:
             try:
                 context.log.info(f"Resetting {place}/{resname}.")
@@ -610,12 +869,11 @@ async def console(context: Session, place: PlaceName):
     if place in context.open_consoles:
         return failed(f"There is already a console open for {place}.")
     # check that place has a console
-    _resources = await fetch_resources(context, place, resource_key=None)
+    _resources = await fetch_resources(context, None, resource_key=None)
     if isinstance(_resources, LabbyError):
         return _resources
-    if len(_resources) == 0:
+    if not context.resource_index.lookup(group=place):
         return failed(f"No resources on {place}.")
-    _resources = flatten(_resources, depth=2)  # remove exporter and place
     _resource: Optional[LabbyResource] = next(
         (
             NetworkSerialPort(
@@ -625,8 +883,8 @@ async def console(context: Session, place: PlaceName):
                 speed=data['params']['speed'],
                 protocol=data['params'].get('protocol', 'rfc2217'),
             )
-            for _, data in _resources.items()
-            if 'cls' in data and data['cls'] == 'NetworkSerialPort'
+            for _, data in _resource_entries(
+                context, context.resource_index.lookup(group=place, cls='NetworkSerialPort'))
         ),
         None,
     )
@@ -638,11 +896,13 @@ async def console(context: Session, place: PlaceName):
                                                     speed=_resource.speed,
                                                     port=_resource.port,
                                                     ssh_session=context.ssh_session.client))
+    _watch_console_idle(context, place)
 
     async def _read(read_fn,):
         while place in context.open_consoles:
             try:
                 data = await read_fn()
+                _con.last_activity = get_scheduler().loop.time()
                 assert context.frontend
                 context.frontend.publish(f"localhost.consoles.{place}", data)
             except (OSError, EOFError):
@@ -666,6 +926,49 @@ async def console(context: Session, place: PlaceName):
     return True
 
 
+def console_idle_timeout() -> Optional[float]:
+    """
+    Seconds until idle consoles are closed, overridden by LABBY_CONSOLE_IDLE_TIMEOUT. None or 0 keeps them open.
+    """
+    spec = os.environ.get('LABBY_CONSOLE_IDLE_TIMEOUT')
+    if not spec:
+        return CONSOLE_IDLE_TIMEOUT
+    try:
+        return float(spec) or None
+    except ValueError:
+        asyncio.log.logger.error(f"Invalid LABBY_CONSOLE_IDLE_TIMEOUT '{spec}', consoles are kept open.")
+        return None
+
+
+def _watch_console_idle(context: Session, place: PlaceName):
+    """
+    Close the console on place once it has been idle for console_idle_timeout() seconds,
+    the frontend is told on the console's topic
+    """
+    if (timeout := console_idle_timeout()) is None:
+        return
+    # the timer fires outside of the calling session's context
+    open_consoles = context.open_consoles
+    _console = open_consoles[place]
+    scheduler = get_scheduler()
+    _console.last_activity = scheduler.loop.time()
+
+    def _check_idle():
+        if open_consoles.get(place) is not _console:
+            return
+        # the timer is only moved when it fires, not on every read or write
+        if (idle_at := _console.last_activity + timeout) > scheduler.loop.time():
+            _console.idle_timer = scheduler.call_at(idle_at, _check_idle)
+            return
+        context.log.info(f"Closing idle console on {place}.")
+        del open_consoles[place]
+        _console.close()
+        if (frontend := getattr(context, 'frontend', None)) is not None:
+            frontend.publish(f"localhost.consoles.{place}",
+                             f"\r\nConsole closed after {timeout / 60:.0f} minutes idle.\r\n")
+    _console.idle_timer = scheduler.call_at(_console.last_activity + timeout, _check_idle)
+
+
 @labby_serialized
 async def console_write(context: Session, place: PlaceName, data: str) -> Union[bool, LabbyError]:
     # TODO implement
@@ -678,6 +981,7 @@ async def console_write(context: Session, place: PlaceName, data: str) -> Union[
         return failed(f"Could not write to Console {place}. Data was empty")
     try:
         _console.write_to_stdin(data)
+        _console.last_activity = get_scheduler().loop.time()
     except Exception as e:
         context.log.exception(e)
         return failed(f"Failed to write to Console {place}.")
@@ -770,6 +1074,7 @@ async def places_names(context: Session) -> Union[List[PlaceName], LabbyError]:
 
 
 @labby_serialized
+@memoized(lambda place: [f"place:{place}"])
 async def get_alias(context: Session, place: PlaceName) -> Union[List[str], LabbyError]:
     if place is None:
         return invalid_parameter("Missing required parameter: place.")
@@ -810,6 +1115,53 @@ async def del_match(context: Session,
         return failed(f"Failed to add match {exporter}/{group}/{cls}/{name} to place {place}.")
 
 
+async def fetch_matches(context: Session) -> Optional[LabbyError]:
+    """
+    Make sure the place matches are resolved, this may update context.places and context.resources.
+    Matches are only resolved completely after places or resources have been refreshed.
+    """
+    places_data = await fetch_places(context, None)
+    if isinstance(places_data, LabbyError):
+        return places_data
+    resource_data = await fetch_resources(context, None, None)
+    if isinstance(resource_data, LabbyError):
+        return resource_data
+    if context.matches.dirty:
+        context.matches.rebuild(places_data, context.resource_index)
+    return None
+
+
+@labby_serialized
+async def place_resources(context: Session, place: PlaceName) -> Union[List[Resource], LabbyError]:
+    """
+    rpc: returns all resources matched by the matches of a place
+    """
+    if place is None:
+        return invalid_parameter("Missing required parameter: place.")
+    if err := await fetch_matches(context):
+        return err
+    if place not in context.matches.matches:
+        return not_found(f"Place {place} not found.")
+    return [{'name': name, 'target': exporter, 'place': group, **values}
+            for (exporter, group, name), values in _resource_entries(
+                context, context.matches.resources_for(place))]
+
+
+@labby_serialized
+async def resource_places(context: Session,
+                          exporter: ExporterName,
+                          group: GroupName,
+                          name: ResourceName) -> Union[List[PlaceName], LabbyError]:
+    """
+    rpc: returns the names of all places matching a resource
+    """
+    if exporter is None or group is None or name is None:
+        return invalid_parameter("Missing required parameter: exporter, group and name.")
+    if err := await fetch_matches(context):
+        return err
+    return sorted(context.matches.places_for((exporter, group, name)))
+
+
 @labby_serialized
 async def acquire_resource(context: Session,
                            place_name: PlaceName,
@@ -856,6 +1208,105 @@ async def cli_command(context: Session, command: str) -> Union[str, LabbyError]:
         return failed("Failed to execute cli command.")
 
 
+@labby_serialized
+async def stats(context: Session) -> Dict:
+    """
+    rpc: returns cache telemetry of this labby instance
+    """
+    context.stats.gauges['scheduler_wakeups'] = get_scheduler().wakeups
+    return context.stats.to_json()
+
+
+@labby_serialized
+async def snapshot(context: Session) -> Union[Dict, LabbyError]:
+    """
+    rpc: returns places and resources together with their version,
+    follow localhost.onDelta or call resync afterwards to stay current
+    """
+    resource_data = await fetch_resources(context, None, None)
+    if isinstance(resource_data, LabbyError):
+        return resource_data
+    place_list = await places(context)
+    if isinstance(place_list, dict):  # serialized LabbyError
+        return place_list
+    # places() builds the views last, no await from here on,
+    # so data and version belong together
+    return {
+        'version': context.deltas.version,
+        'places': context.place_views.to_list(),
+        'resources': context.resources.get_soft(),
+    }
+
+
+@labby_serialized
+async def resync(context: Session, since_version: int) -> Union[Dict, LabbyError]:
+    """
+    rpc: returns all patches after since_version, fails if a new snapshot is needed
+    """
+    if not isinstance(since_version, int):
+        return invalid_parameter("Missing required parameter: since_version.")
+    patches = context.deltas.since(since_version)
+    if patches is None:
+        return not_found(f"Changes since version {since_version} are not available, fetch a new snapshot.")
+    return {'version': context.deltas.version, 'patches': patches}
+
+
+def _batch_endpoint(endpoint: Any) -> Optional[str]:
+    if not isinstance(endpoint, str):
+        return None
+    return endpoint[len("localhost."):] if endpoint.startswith("localhost.") else endpoint
+
+
+@labby_serialized
+async def batch(_context: Session, procedures: Dict[str, Callable], calls: List) -> Union[List, LabbyError]:
+    """
+    rpc: execute a list of [endpoint, args, kwargs] calls against the registered procedures in one round trip,
+    args and kwargs are optional. Consecutive read only calls run concurrently, all others in order.
+    Returns the results in order, failed calls as serialized LabbyError.
+    """
+    if not isinstance(calls, list):
+        return invalid_parameter("Calls must be a list of [endpoint, args, kwargs] calls.")
+
+    async def _call(call):
+        if not isinstance(call, (list, tuple)) or not 1 <= len(call) <= 3:
+            return invalid_parameter(f"Invalid call {call}, expected [endpoint, args, kwargs].").to_json()
+        key = _batch_endpoint(call[0])
+        call_args = call[1] if len(call) > 1 and call[1] is not None else []
+        call_kwargs = call[2] if len(call) > 2 and call[2] is not None else {}
+        if key == "batch" or key not in procedures:
+            return not_found(f"Endpoint {call[0]} not found.").to_json()
+        if not isinstance(call_args, list):
+            call_args = [call_args]
+        # details are the batch caller's, they must not be passed on
+        if not isinstance(call_kwargs, dict) or 'details' in call_kwargs:
+            return invalid_parameter(f"Invalid keyword arguments {call_kwargs} for {call[0]}.").to_json()
+        try:
+            ret = await procedures[key](*call_args, **call_kwargs)
+        except Exception as err:  # pylint: disable=broad-except
+            return failed(f"Call to {call[0]} failed: {err}").to_json()
+        return ret.to_json() if isinstance(ret, LabbyError) else ret
+
+    results: List = []
+    concurrent: List = []
+    for call in calls:
+        if isinstance(call, (list, tuple)) and call and _batch_endpoint(call[0]) in READ_ONLY_ENDPOINTS:
+            concurrent.append(_call(call))
+            continue
+        results.extend(await asyncio.gather(*concurrent))
+        concurrent = []
+        results.append(await _call(call))
+    results.extend(await asyncio.gather(*concurrent))
+    return results
+
+
+@labby_serialized
+async def metrics(context: Session) -> Dict:
+    """
+    rpc: returns calls, errors, calls in flight and latencies of all rpc endpoints
+    """
+    return {name: endpoint.to_json() for name, endpoint in context.stats.endpoints.items()}
+
+
 @labby_serialized
 async def username(context: Session) -> Union[str, LabbyError]:
-    return context.user_name or failed("Username has not been set correctly.")
+    return context.client.identity or context.user_name or failed("Username has not been set correctly.")
@@ -0,0 +1,190 @@
+"""
+Shared timer scheduler for labby, owns all expiry deadlines of an event loop
+"""
+
+import asyncio
+import heapq
+import itertools
+from typing import Any, Callable, List, Optional, Tuple
+from weakref import WeakKeyDictionary
+
+
+class ScheduledCall:
+    """
+    Handle for a callback scheduled on a Scheduler
+    """
+
+    def __init__(self, scheduler: "Scheduler", deadline: float, callback: Callable, args: Tuple) -> None:
+        self.deadline = deadline
+        self.cancelled = False
+        self._active = True
+        self._scheduler = scheduler
+        self._callback = callback
+        self._args = args
+
+    def cancel(self):
+        """
+        Cancel the call, does nothing if it already ran or was cancelled
+        """
+        if self._active:
+            self._active = False
+            self.cancelled = True
+            self._scheduler._cancelled(self)
+
+    def _run(self):
+        self._active = False
+        self._callback(*self._args)
+
+
+class Scheduler:
+    """
+    Heap of deadlines, using a single loop timer armed for the earliest deadline.
+    The loop is only woken when a deadline is due.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop) -> None:
+        self.loop = loop
+        # number of times the scheduler has been woken up by the loop
+        self.wakeups: int = 0
+        self._heap: List[Tuple[float, int, ScheduledCall]] = []
+        self._sequence = itertools.count()
+        self._num_cancelled: int = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._timer_deadline: Optional[float] = None
+
+    def __len__(self) -> int:
+        return len(self._heap) - self._num_cancelled
+
+    def call_at(self, deadline: float, callback: Callable, *args: Any) -> ScheduledCall:
+        """
+        Run callback at deadline (in loop time)
+        """
+        call = ScheduledCall(self, deadline, callback, args)
+        heapq.heappush(self._heap, (deadline, next(self._sequence), call))
+        if self._timer_deadline is None or deadline < self._timer_deadline:
+            self._arm()
+        return call
+
+    def call_later(self, delay: float, callback: Callable, *args: Any) -> ScheduledCall:
+        """
+        Run callback after delay seconds
+        """
+        return self.call_at(self.loop.time() + delay, callback, *args)
+
+    async def sleep(self, delay: float):
+        """
+        Drop in for asyncio.sleep using the shared timer
+        """
+        future = self.loop.create_future()
+
+        def _wake():
+            if not future.done():
+                future.set_result(None)
+        call = self.call_later(delay, _wake)
+        try:
+            await future
+        finally:
+            call.cancel()
+
+    def _cancelled(self, call: ScheduledCall):
+        self._num_cancelled += 1
+        if self._num_cancelled > len(self._heap) // 2:
+            # too many dead entries, rebuild the heap
+            self._heap = [entry for entry in self._heap if entry[2]._active]
+            heapq.heapify(self._heap)
+            self._num_cancelled = 0
+        if call.deadline == self._timer_deadline:
+            # avoid waking up for nothing
+            self._arm()
+
+    def _pop_cancelled(self):
+        while self._heap and not self._heap[0][2]._active:
+            heapq.heappop(self._heap)
+            self._num_cancelled -= 1
+
+    def _arm(self):
+        self._pop_cancelled()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+            self._timer_deadline = None
+        if self._heap:
+            self._timer_deadline = self._heap[0][0]
+            self._timer = self.loop.call_at(self._timer_deadline, self._wakeup)
+
+    def _wakeup(self):
+        self.wakeups += 1
+        self._timer = None
+        self._timer_deadline = None
+        now = self.loop.time()
+        while self._heap and self._heap[0][0] <= now:
+            _, _, call = heapq.heappop(self._heap)
+            if not call._active:
+                self._num_cancelled -= 1
+                continue
+            try:
+                call._run()
+            except Exception as exc:  # pylint: disable=broad-except
+                self.loop.call_exception_handler(
+                    {'message': 'Exception in scheduled call', 'exception': exc})
+        self._arm()
+
+
+_schedulers: "WeakKeyDictionary[asyncio.AbstractEventLoop, Scheduler]" = WeakKeyDictionary()
+
+
+def get_scheduler(loop: Optional[asyncio.AbstractEventLoop] = None) -> Scheduler:
+    """
+    Return the shared scheduler of the given or current event loop
+    """
+    loop = loop or asyncio.get_event_loop()
+    if loop not in _schedulers:
+        _schedulers[loop] = Scheduler(loop)
+    return _schedulers[loop]
+
+
+class Wakeup:
+    """
+    Wakes a single waiter, a wakeup without a waiter is kept for the next wait.
+    set may be called from any thread, the waiter is woken on its own loop.
+    """
+
+    def __init__(self) -> None:
+        self._pending = False
+        self._future: Optional[asyncio.Future] = None
+
+    def set(self):
+        if (future := self._future) is not None and not future.done():
+            future.get_loop().call_soon_threadsafe(self._wake, future)
+        else:
+            self._pending = True
+
+    def _wake(self, future: asyncio.Future):
+        if future.done():
+            # timed out meanwhile, keep the wakeup
+            self._pending = True
+        else:
+            future.set_result(True)
+
+    async def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait for a wakeup or timeout seconds, returns False on timeout
+        """
+        loop = asyncio.get_event_loop()
+        self._future = future = loop.create_future()
+        # a wakeup may have arrived before the future was visible
+        if self._pending:
+            self._pending = False
+            self._future = None
+            return True
+
+        def _timeout():
+            if not future.done():
+                future.set_result(False)
+        call = get_scheduler(loop).call_later(timeout, _timeout) if timeout is not None else None
+        try:
+            return await future
+        finally:
+            self._future = None
+            if call is not None:
+                call.cancel()
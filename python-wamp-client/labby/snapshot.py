@@ -0,0 +1,56 @@
+"""
+On-disk snapshots of labby caches, used to serve data right after a restart
+"""
+
+import mmap
+import os
+from time import time
+from typing import Any, Dict, Optional
+
+try:
+    import msgpack
+except ImportError:  # msgpack comes with autobahn[serialization]
+    msgpack = None
+
+# bump when the layout of the snapshot changes
+SNAPSHOT_FORMAT = 1
+
+
+def snapshots_available() -> bool:
+    return msgpack is not None
+
+
+def save_snapshot(path: str, caches: Dict[str, Dict[str, Any]]) -> bool:
+    """
+    Write caches to path, caches maps a cache name to its
+    'data', 'version' and 'last_refresh'. Replaces the file atomically.
+    """
+    if msgpack is None:
+        return False
+    payload = msgpack.packb({
+        'format': SNAPSHOT_FORMAT,
+        'saved': time(),
+        'caches': caches,
+    }, use_bin_type=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as file:
+        file.write(payload)
+    os.replace(tmp_path, path)
+    return True
+
+
+def load_snapshot(path: str) -> Optional[Dict[str, Dict[str, Any]]]:
+    """
+    Read the caches stored in path, None if there is no usable snapshot
+    """
+    if msgpack is None or not os.path.isfile(path):
+        return None
+    try:
+        with open(path, 'rb') as file:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                snapshot = msgpack.unpackb(mapped, raw=False, strict_map_key=False)
+    except (OSError, ValueError, msgpack.UnpackException):
+        return None
+    if not isinstance(snapshot, dict) or snapshot.get('format') != SNAPSHOT_FORMAT:
+        return None
+    return snapshot.get('caches')
@@ -0,0 +1,251 @@
+"""
+Telemetry for labby caches and rpc endpoints
+"""
+
+import json
+import os
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import time
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+# upper bounds in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.)
+
+
+def payload_size(data: Any) -> int:
+    """
+    approximate serialized size of data in bytes
+    """
+    try:
+        return len(json.dumps(data, default=str))
+    except (TypeError, ValueError):
+        return 0
+
+
+class Histogram:
+    """
+    Cumulative histogram, Prometheus style
+    """
+
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS) -> None:
+        self.buckets = tuple(buckets)
+        self.counts: List[int] = [0] * (len(self.buckets) + 1)  # last one is +Inf
+        self.sum: float = 0.
+        self.count: int = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> List[int]:
+        ret = []
+        total = 0
+        for count in self.counts:
+            total += count
+            ret.append(total)
+        return ret
+
+    def to_json(self):
+        return {
+            'buckets': dict(zip([*map(str, self.buckets), '+Inf'], self.cumulative())),
+            'sum': self.sum,
+            'count': self.count,
+        }
+
+
+class CacheStats:
+    """
+    Counters for a single cache
+    """
+
+    def __init__(self) -> None:
+        self.hits: int = 0
+        self.misses: int = 0
+        self.stale_hits: int = 0
+        self.refreshes: int = 0
+        self.refresh_errors: int = 0
+        self.refresh_latency = Histogram()
+        self.last_refresh: Optional[float] = None
+        # last refreshed data, only serialized once its size is read
+        self._payload: Any = None
+        self._payload_bytes: Optional[int] = 0
+
+    @property
+    def payload_bytes(self) -> int:
+        if self._payload_bytes is None:
+            self._payload_bytes = payload_size(self._payload)
+            self._payload = None
+        return self._payload_bytes
+
+    def refreshed(self, duration: float, data: Any):
+        self.refreshes += 1
+        self.refresh_latency.observe(duration)
+        self._payload = data
+        self._payload_bytes = None
+        self.last_refresh = time()
+
+    def to_json(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale_hits': self.stale_hits,
+            'refreshes': self.refreshes,
+            'refresh_errors': self.refresh_errors,
+            'refresh_latency': self.refresh_latency.to_json(),
+            'payload_bytes': self.payload_bytes,
+            'last_refresh': self.last_refresh,
+        }
+
+
+# seconds spent waiting for the coordinator by the current rpc call, shared with its subtasks
+_coordinator_time: ContextVar[Optional[List[float]]] = ContextVar('labby_coordinator_time', default=None)
+
+
+def record_coordinator_time(duration: float):
+    if (acc := _coordinator_time.get()) is not None:
+        acc[0] += duration
+
+
+@contextmanager
+def coordinator_time() -> Iterator[List[float]]:
+    """
+    Accumulate the coordinator time of everything run within, in the single list entry.
+    Nested calls, e.g. in a batch, are accounted to the outer call as well.
+    """
+    acc = [0.]
+    token = _coordinator_time.set(acc)
+    try:
+        yield acc
+    finally:
+        _coordinator_time.reset(token)
+        record_coordinator_time(acc[0])
+
+
+class EndpointStats:
+    """
+    Counters for a single rpc endpoint
+    """
+
+    def __init__(self) -> None:
+        self.calls: int = 0
+        # by LabbyError kind or exception type
+        self.errors: Dict[str, int] = {}
+        self.in_flight: int = 0
+        self.latency = Histogram()
+        self.coordinator_latency = Histogram()
+        self.compute_latency = Histogram()
+
+    def observe(self, duration: float, coordinator: float, error: Optional[str] = None):
+        self.calls += 1
+        if error is not None:
+            self.errors[error] = self.errors.get(error, 0) + 1
+        self.latency.observe(duration)
+        self.coordinator_latency.observe(coordinator)
+        # concurrent coordinator calls may add up to more than the call took
+        self.compute_latency.observe(max(duration - coordinator, 0.))
+
+    def to_json(self):
+        return {
+            'calls': self.calls,
+            'errors': dict(self.errors),
+            'in_flight': self.in_flight,
+            'latency': self.latency.to_json(),
+            'coordinator_latency': self.coordinator_latency.to_json(),
+            'compute_latency': self.compute_latency.to_json(),
+        }
+
+
+def _labels(**labels) -> str:
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+
+def _prometheus_histogram(name: str, hist: Histogram, **labels) -> List[str]:
+    lines = [f"{name}_bucket{_labels(**labels, le=le)} {count}"
+             for le, count in zip([*map(str, hist.buckets), '+Inf'], hist.cumulative())]
+    lines.append(f"{name}_sum{_labels(**labels)} {hist.sum}")
+    lines.append(f"{name}_count{_labels(**labels)} {hist.count}")
+    return lines
+
+
+class StatsRegistry:
+    """
+    All telemetry of a labby session
+    """
+
+    def __init__(self) -> None:
+        self.caches: Dict[str, CacheStats] = {}
+        self.endpoints: Dict[str, EndpointStats] = {}
+        # additional gauges, e.g. scheduler wakeups
+        self.gauges: Dict[str, float] = {}
+
+    def cache(self, name: str) -> CacheStats:
+        if name not in self.caches:
+            self.caches[name] = CacheStats()
+        return self.caches[name]
+
+    def endpoint(self, name: str) -> EndpointStats:
+        if name not in self.endpoints:
+            self.endpoints[name] = EndpointStats()
+        return self.endpoints[name]
+
+    def to_json(self):
+        return {
+            'caches': {name: stats.to_json() for name, stats in self.caches.items()},
+            'endpoints': {name: stats.to_json() for name, stats in self.endpoints.items()},
+            **self.gauges,
+        }
+
+    def to_prometheus(self) -> str:
+        lines = []
+        counters = {
+            'hits': 'labby_cache_hits_total',
+            'misses': 'labby_cache_misses_total',
+            'stale_hits': 'labby_cache_stale_hits_total',
+            'refreshes': 'labby_cache_refreshes_total',
+            'refresh_errors': 'labby_cache_refresh_errors_total',
+        }
+        for attribute, metric in counters.items():
+            lines.append(f"# TYPE {metric} counter")
+            lines.extend(f"{metric}{_labels(cache=name)} {getattr(stats, attribute)}"
+                         for name, stats in self.caches.items())
+        lines.append("# TYPE labby_cache_refresh_seconds histogram")
+        for name, stats in self.caches.items():
+            lines.extend(_prometheus_histogram(
+                "labby_cache_refresh_seconds", stats.refresh_latency, cache=name))
+        lines.append("# TYPE labby_cache_payload_bytes gauge")
+        lines.extend(f"labby_cache_payload_bytes{_labels(cache=name)} {stats.payload_bytes}"
+                     for name, stats in self.caches.items())
+        lines.append("# TYPE labby_cache_last_refresh_timestamp_seconds gauge")
+        lines.extend(f"labby_cache_last_refresh_timestamp_seconds{_labels(cache=name)} {stats.last_refresh}"
+                     for name, stats in self.caches.items() if stats.last_refresh is not None)
+        lines.append("# TYPE labby_rpc_calls_total counter")
+        lines.extend(f"labby_rpc_calls_total{_labels(endpoint=name)} {stats.calls}"
+                     for name, stats in self.endpoints.items())
+        lines.append("# TYPE labby_rpc_errors_total counter")
+        lines.extend(f"labby_rpc_errors_total{_labels(endpoint=name, kind=kind)} {count}"
+                     for name, stats in self.endpoints.items() for kind, count in stats.errors.items())
+        lines.append("# TYPE labby_rpc_in_flight gauge")
+        lines.extend(f"labby_rpc_in_flight{_labels(endpoint=name)} {stats.in_flight}"
+                     for name, stats in self.endpoints.items())
+        for metric, attribute in (('labby_rpc_seconds', 'latency'),
+                                  ('labby_rpc_coordinator_seconds', 'coordinator_latency'),
+                                  ('labby_rpc_compute_seconds', 'compute_latency')):
+            lines.append(f"# TYPE {metric} histogram")
+            for name, stats in self.endpoints.items():
+                lines.extend(_prometheus_histogram(metric, getattr(stats, attribute), endpoint=name))
+        for name, value in self.gauges.items():
+            lines.append(f"# TYPE labby_{name} gauge")
+            lines.append(f"labby_{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: str):
+        """
+        Write all stats in Prometheus text format, replaces the file atomically
+        """
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            file.write(self.to_prometheus())
+        os.replace(tmp_path, path)
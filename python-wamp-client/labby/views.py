@@ -0,0 +1,87 @@
+"""
+Materialised views of places as served by localhost.places
+"""
+
+from typing import Callable, Dict, List, Optional
+
+PlaceName = str
+Places = Dict[PlaceName, Dict]
+
+
+def _exporter(place_data: Dict) -> Optional[str]:
+    # ??? (Kevin) what if there are more than one or no matches
+    if len(place_data["matches"]) > 0 and 'exporter' in place_data["matches"]:
+        return place_data["matches"][0]["exporter"]
+    return None
+
+
+class PlaceViews:
+    """
+    Coordinator place data together with the derived name, exporter, power state,
+    reservation and staleness. Views are copies, the raw place data is never modified.
+    """
+
+    def __init__(self) -> None:
+        self.views: Dict[PlaceName, Dict] = {}
+        # set, when places or resources have been refreshed completely
+        self.dirty: bool = True
+        self._list: Optional[List[Dict]] = None
+        # called with name and new view (None if removed) of a single changed place
+        self.on_change: List[Callable[[PlaceName, Optional[Dict]], None]] = []
+
+    def rebuild(self, places: Optional[Places], power_state: Callable[[PlaceName], Optional[bool]],
+                reservation: Callable[[PlaceName], Optional[str]], stale: bool = False):
+        self.views = {name: self._view(name, data, power_state(name), reservation(name), stale)
+                      for name, data in (places or {}).items() if data}
+        self._list = None
+        self.dirty = False
+
+    def update(self, name: PlaceName, place_data: Optional[Dict], power_state: Optional[bool],
+               reservation: Optional[str], stale: bool = False):
+        """
+        Rebuild the view of a single changed place, empty data removes it
+        """
+        if self.dirty:
+            return
+        if place_data:
+            self.views[name] = self._view(name, place_data, power_state, reservation, stale)
+        else:
+            self.views.pop(name, None)
+        self._list = None
+        self._changed(name)
+
+    def set_power_state(self, name: PlaceName, power_state: Optional[bool]):
+        self._set(name, 'power_state', power_state)
+
+    def set_reservation(self, name: PlaceName, reservation: Optional[str]):
+        self._set(name, 'reservation', reservation)
+
+    def to_list(self, place: Optional[PlaceName] = None) -> List[Dict]:
+        if place is not None:
+            return [self.views[place]] if place in self.views else []
+        if self._list is None:
+            self._list = list(self.views.values())
+        return self._list
+
+    def _set(self, name: PlaceName, field: str, value):
+        if (view := self.views.get(name)) is not None and view[field] != value:
+            # replace instead of modifying, views may still be in flight
+            self.views[name] = {**view, field: value}
+            self._list = None
+            self._changed(name)
+
+    def _changed(self, name: PlaceName):
+        for listener in self.on_change:
+            listener(name, self.views.get(name))
+
+    @staticmethod
+    def _view(name: PlaceName, place_data: Dict, power_state: Optional[bool],
+              reservation: Optional[str], stale: bool) -> Dict:
+        return {
+            **place_data,
+            "name": name,
+            "exporter": _exporter(place_data),
+            "power_state": power_state,
+            "reservation": reservation,
+            "stale": stale,
+        }
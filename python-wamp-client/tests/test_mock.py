@@ -3,7 +3,11 @@ Mock tests for labby module
 """
 
 import asyncio
+import copy
+import os
 import sys
+import tempfile
+import threading
 import unittest
 from datetime import datetime
 from random import random
@@ -14,11 +18,24 @@ from uuid import uuid4
 
 import yaml
 from autobahn.asyncio.wamp import ApplicationSession, ApplicationRunner
+from autobahn.wamp.exception import ApplicationError
 
+from labby.admission import AdmissionControl, Limiter, parse_limits
+from labby.cache import MISSING, Cache, CounterStrategy, PeriodicRefreshStrategy, ResultCache
+from labby import labby as labby_module
 from labby.labby import LabbyClient, RouterInterface, run_router
 from labby.labby_error import ErrorKind, LabbyError
 from labby.labby_types import Place, PowerState, SerLabbyError, Session
 from labby import rpc
+from labby.clients import Clients
+from labby.deltas import DeltaLog
+from labby.index import Reservations, ResourceIndex
+from labby.matches import MatchIndex
+from labby.power import PowerStates
+from labby.publisher import EventCoalescer, resource_topic
+from labby.scheduler import Scheduler, Wakeup
+from labby.snapshot import load_snapshot, save_snapshot
+from labby.stats import coordinator_time
 
 
 PLACES = None
@@ -30,6 +47,20 @@ with open("tests/resources.yaml", 'r') as file:
     RESOURCES = list(yaml.load_all(file, yaml.loader.FullLoader))[0]
 
 
+# LabbyClient loads and saves its snapshot, keep it out of the working directory
+SNAPSHOT_DIR = tempfile.TemporaryDirectory()
+SNAPSHOT_ENV = patch.dict(os.environ, {'LABBY_SNAPSHOT_PATH': os.path.join(SNAPSHOT_DIR.name, 'snapshot')})
+
+
+def setUpModule():
+    SNAPSHOT_ENV.start()
+
+
+def tearDownModule():
+    SNAPSHOT_ENV.stop()
+    SNAPSHOT_DIR.cleanup()
+
+
 def make_async(func: Callable):
     """
     wrap a function with a future to make it async
@@ -230,6 +261,36 @@ class TestPlaces(unittest.TestCase):
         assert isinstance(places, LabbyError)
         assert places.kind == ErrorKind.NOT_FOUND
 
+    @async_test
+    async def test_places_views(self):
+        """
+        test places are served from views, leaving the coordinator data untouched
+        """
+        context = MockSession()
+        ret = await rpc.places(context)
+        assert ret[0]['name'] == 'mle-lg-ref-1'
+        assert 'name' not in context.places.get_soft()['mle-lg-ref-1']
+        assert await rpc.places(context) is ret
+        context.reservations['token9'] = {'state': 'waiting', 'filters': {'main': {'name': 'mle-lg-ref-1'}}}
+        ret = await rpc.places(context, 'mle-lg-ref-1')
+        assert ret[0]['reservation'] == 'token9'
+        context.reservations.clear()
+        assert context.place_views.to_list('mle-lg-ref-1')[0]['reservation'] is None
+
+    @async_test
+    @patch.object(ApplicationSession, 'publish')
+    async def test_places_views_follow_changes(self, _):
+        """
+        test views are updated by the change handlers
+        """
+        client = LabbyClient(config=MagicMock())
+        client.places.seed(copy.deepcopy(PLACES), last_refresh=1.)
+        client.place_views.rebuild(client.places.get_soft(), lambda _: None, lambda _: None)
+        await client.on_place_changed('mle-lg-ref-1', {**PLACES['mle-lg-ref-1'], 'comment': 'changed'})
+        assert client.place_views.to_list('mle-lg-ref-1')[0]['comment'] == 'changed'
+        await client.on_place_changed('mle-lg-ref-1', {})
+        assert not client.place_views.to_list()
+
 
 class TestPowerState(unittest.TestCase):
     """
@@ -464,6 +525,442 @@ class TestReservation(unittest.TestCase):
         assert isinstance(poll, Dict)
         assert 'error' not in poll
 
+    @async_test
+    async def test_refresh_reservations_idle(self):
+        context = MockSession()
+        calls = []
+        call = context.call
+
+        def counting_call(func_str, *args, **kwargs):
+            calls.append(func_str)
+            return call(func_str, *args, **kwargs)
+        context.call = counting_call
+        task = asyncio.ensure_future(rpc.refresh_reservations(context))
+        await asyncio.sleep(0.05)
+        # nothing to refresh, nothing to ask the coordinator
+        assert not calls
+        await rpc.create_reservation(context, "place2")
+        await asyncio.sleep(0.05)
+        # woken up by the new token, reservations are shared with create_reservation
+        assert calls.count("org.labgrid.coordinator.get_reservations") == 1
+        assert calls.count("org.labgrid.coordinator.poll_reservation") == 1
+        await asyncio.sleep(0.05)
+        # backing off
+        assert calls.count("org.labgrid.coordinator.poll_reservation") == 1
+        task.cancel()
+
+    @async_test
+    async def test_reservations_cached(self):
+        context = MockSession()
+        calls = []
+        call = context.call
+
+        def counting_call(func_str, *args, **kwargs):
+            calls.append(func_str)
+            return call(func_str, *args, **kwargs)
+        context.call = counting_call
+        await rpc.places(context)
+        await rpc.places(context)
+        await rpc.cancel_reservation(context, 'place1')
+        assert calls.count("org.labgrid.coordinator.get_reservations") == 1
+
+        async def expired(_):
+            return {'token1': {'state': 'expired', 'filters': {'main': {'name': 'place1'}}}}
+        context.reservation_data.invalidate()
+        context.reservation_data.refresh_data = expired
+        await rpc.get_reservations(context)
+        # expired reservations are dropped
+        assert not context.reservations
+
+    @async_test
+    async def test_reservations_shared_across_loops(self):
+        context = MockSession()
+        calls = []
+        call = context.call
+
+        async def slow_call(func_str, *args, **kwargs):
+            calls.append(func_str)
+            await asyncio.sleep(0.05)
+            return await call(func_str, *args, **kwargs)
+        context.call = slow_call
+        # refresh_reservations runs on the labby loop, the frontend router on its own
+        labby_loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=labby_loop.run_forever)
+        thread.start()
+        try:
+            refreshing = asyncio.run_coroutine_threadsafe(context.reservation_data.get(context), labby_loop)
+            await asyncio.sleep(0.01)
+            assert 'token1' in await rpc.get_reservations(context)
+            assert 'token1' in await asyncio.wrap_future(refreshing)
+            assert calls == ["org.labgrid.coordinator.get_reservations"]
+        finally:
+            labby_loop.call_soon_threadsafe(labby_loop.stop)
+            thread.join()
+            labby_loop.close()
+
+    @async_test
+    async def test_refresh_reservations_concurrent(self):
+        context = MockSession()
+        reservations = {f"token{i}": {'owner': context.user_name, 'state': 'waiting', 'timeout': 0.,
+                                      'filters': {'main': {'name': f"place{i}"}}} for i in range(4)}
+        polled = []
+        running = []
+
+        async def call(func_str, *args, **_):
+            if func_str == "org.labgrid.coordinator.get_reservations":
+                return copy.deepcopy(reservations)
+            token = args[0]
+            running.append(token)
+            if token == 'token0':
+                await asyncio.sleep(10)  # stalled poll
+            await asyncio.sleep(0.01)
+            polled.append((token, len(running)))
+            running.remove(token)
+            return reservations[token]
+        context.call = call
+        context.to_refresh.update(reservations)
+        task = asyncio.ensure_future(rpc.refresh_reservations(context, concurrency=2, call_timeout=0.05))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        assert sorted(token for token, _ in polled) == ['token1', 'token2', 'token3']
+        assert all(num_running <= 2 for _, num_running in polled)
+        assert context.to_refresh == set(reservations)
+
+    @async_test
+    async def test_refresh_reservations_failing_token(self):
+        context = MockSession()
+        reservations = {f"token{i}": {'owner': context.user_name, 'state': 'waiting', 'timeout': 0.,
+                                      'filters': {'main': {'name': f"place{i}"}}} for i in range(3)}
+        polled = []
+
+        async def call(func_str, *args, **_):
+            if func_str == "org.labgrid.coordinator.get_reservations":
+                return copy.deepcopy(reservations)
+            polled.append(args[0])
+            if args[0] == 'token0':
+                raise ApplicationError("wamp.error.runtime_error")
+            return reservations[args[0]]
+        context.call = call
+        context.to_refresh.update(reservations)
+        task = asyncio.ensure_future(rpc.refresh_reservations(context))
+        await asyncio.sleep(0.05)
+        assert not task.done()
+        task.cancel()
+        assert sorted(polled) == ['token0', 'token1', 'token2']
+        assert context.to_refresh == set(reservations)
+
+
+class TestPeers(unittest.TestCase):
+    """
+    test peer discovery
+    """
+
+    @async_test
+    async def test_fetch_peers_concurrent(self):
+        context = MockSession()
+        running = []
+        seen = []
+
+        async def call(func_str, *args, **_):
+            if func_str == "wamp.session.list":
+                return [1, 2, 3]
+            running.append(args[0])
+            await asyncio.sleep(0.01)
+            seen.append(len(running))
+            if args[0] == 3:
+                raise ApplicationError("wamp.error.no_such_session")
+            return {'session': args[0], 'authid': f"exporter/exporter{args[0]}"}
+        context.call = call
+        exporters = await rpc.get_exporters(context)
+        assert exporters == ['exporter1', 'exporter2']
+        # all sessions were requested at once
+        assert seen == [3, 3, 3]
+
+    @async_test
+    async def test_peers_follow_meta_events(self):
+        client = LabbyClient(config=MagicMock())
+        client.peers = {'exporter/exporter1': {'session': 1, 'authid': 'exporter/exporter1'}}
+        client.on_peer_joined({'session': 2, 'authid': 'exporter/exporter2'})
+        assert await rpc.get_exporters(client) == ['exporter1', 'exporter2']
+        client.on_peer_left(1)
+        assert await rpc.get_exporters(client) == ['exporter2']
+
+
+class TestProgressive(unittest.TestCase):
+    """
+    test paginated and progressive listings
+    """
+
+    @async_test
+    async def test_paginate(self):
+        chunks = []
+        last = await rpc.paginate(range(250), progress=chunks.append)
+        assert [len(chunk) for chunk in chunks] == [100, 100]
+        assert last == list(range(200, 250))
+        assert await rpc.paginate(range(250), cursor=10, limit=5) == list(range(10, 15))
+        assert isinstance(await rpc.paginate(range(5), cursor=-1), LabbyError)
+
+    @async_test
+    async def test_listings(self):
+        context = MockSession()
+        names = await rpc.resource_names(context)
+        page = await rpc.resource_names(context, cursor=2, limit=3)
+        assert page == names[2:5]
+        overview = await rpc.resource_overview(context)
+        chunks = []
+        last = await rpc.resource_overview(context, progress=chunks.append)
+        assert [res for chunk in chunks for res in chunk] + last == overview
+        assert await rpc.places(context, None, 1) == []
+
+    @async_test
+    async def test_register_progressive(self):
+        client = RouterInterface(MagicMock())
+        client.labby = MockSession()
+        with patch.object(ApplicationSession, 'register') as register:
+            client.register("resource_names", rpc.resource_names, progressive=True)
+        bind = register.call_args[0][0]
+        chunks = []
+        with patch.object(rpc, 'PROGRESS_CHUNK_SIZE', 4):
+            last = await bind(limit=6, details=MagicMock(progress=chunks.append))
+        assert [len(chunk) for chunk in chunks] == [4]
+        assert len(last) == 2
+
+
+class TestProjection(unittest.TestCase):
+    """
+    test field projection and filters of listings
+    """
+
+    @async_test
+    async def test_places(self):
+        context = MockSession()
+        ret = await rpc.places(context, fields=['acquired'])
+        assert [set(view) for view in ret] == [{'name', 'acquired'}]
+        owner = ret[0]['acquired']
+        assert owner
+        assert await rpc.places(context, acquired=False) == []
+        assert len(await rpc.places(context, acquired=owner, exporter='exporter1')) == 1
+        assert await rpc.places(context, exporter='unknown') == []
+        assert await rpc.places(context, available=True) == []
+        ret = await rpc.places(context, fields='acquired')
+        assert ret['error']['kind'] == ErrorKind.INVALID_PARAMETER.value
+
+    @async_test
+    async def test_resource_overview(self):
+        context = MockSession()
+        ret = await rpc.resource_overview(context, cls='NetworkSerialPort', fields=['target', 'avail'])
+        assert {'name': 'USBSerialPort', 'target': 'exporter1', 'avail': True} in ret
+        assert all(set(entry) <= {'name', 'target', 'avail'} for entry in ret)
+        overview = await rpc.resource_overview(context)
+        acquired = await rpc.resource_overview(context, acquired=True, exporter='exporter1')
+        assert acquired == [entry for entry in overview
+                            if entry['acquired'] and entry['target'] == 'exporter1']
+
+    @async_test
+    async def test_positional_fields(self):
+        client = RouterInterface(MagicMock())
+        client.labby = MockSession()
+        with patch.object(ApplicationSession, 'register') as register:
+            client.register("places", rpc.places, progressive=True)
+            client.register("batch", rpc.batch, client.procedures)
+        places_bind, batch_bind = (call[0][0] for call in register.call_args_list)
+        ret = await places_bind(None, 0, None, ['acquired'])
+        assert [set(view) for view in ret] == [{'name', 'acquired'}]
+        ret = await batch_bind([['places', [None, 0, None, ['acquired']]]])
+        assert [set(view) for view in ret[0]] == [{'name', 'acquired'}]
+
+
+class TestDeltas(unittest.TestCase):
+    """
+    test the snapshot plus delta protocol
+    """
+
+    def test_delta_log(self):
+        log = DeltaLog(maxlen=2)
+        published = []
+        log.listeners.append(published.append)
+        log.append('place', 'place1', {'name': 'place1'})
+        log.append('place', 'place1', None)
+        assert [patch['version'] for patch in log.since(0)] == [1, 2]
+        log.append('resource', ['exporter1', 'group1', 'port1'], {'cls': 'NetworkSerialPort'})
+        assert log.since(0) is None  # fell out of the log
+        assert [patch['version'] for patch in log.since(1)] == [2, 3]
+        assert log.since(3) == []
+        assert log.since(4) is None
+        log.reset()
+        assert log.since(3) is None
+        assert [patch['kind'] for patch in published] == ['place', 'place', 'resource', 'reset']
+
+    @async_test
+    @patch.object(ApplicationSession, 'publish')
+    async def test_snapshot_resync(self, _):
+        client = LabbyClient(config=MagicMock())
+        client.call = MockSession.call.__get__(client)
+        client.user_name = 'client/labby/dummy'
+        snap = await rpc.snapshot(client)
+        version = snap['version']
+        assert snap['places'][0]['name'] == 'mle-lg-ref-1'
+        assert 'exporter1' in snap['resources']
+        await client.on_place_changed('mle-lg-ref-1', {**PLACES['mle-lg-ref-1'], 'comment': 'changed'})
+        await client.on_resource_changed('exporter9', 'group9', 'port9', {'cls': 'NetworkSerialPort', 'acquired': None})
+        ret = await rpc.resync(client, version)
+        assert [patch['kind'] for patch in ret['patches']] == ['place', 'resource']
+        assert ret['patches'][0]['data']['comment'] == 'changed'
+        assert ret['version'] == version + 2
+        client.events.flush()
+        published = {call[0][0]: call[0][1] for call in client.frontend.publish.call_args_list}
+        assert [patch['kind'] for patch in published["localhost.onDelta"]][-2:] == ['place', 'resource']
+        ret = await rpc.resync(client, version + 10)
+        assert ret['error']['kind'] == ErrorKind.NOT_FOUND.value
+
+    @async_test
+    @patch.object(ApplicationSession, 'publish')
+    async def test_single_delta_per_change(self, _):
+        client = LabbyClient(config=MagicMock())
+        client.call = MockSession.call.__get__(client)
+        client.user_name = 'client/labby/dummy'
+        with patch.dict(PLACES, copy.deepcopy(PLACES)):
+            version = (await rpc.snapshot(client))['version']
+            assert client.power_states.states['mle-lg-ref-1']
+            # releasing the resources flips the power state as well
+            await client.on_place_changed('mle-lg-ref-1', {**PLACES['mle-lg-ref-1'], 'acquired_resources': []})
+        ret = await rpc.resync(client, version)
+        assert [patch['kind'] for patch in ret['patches']] == ['place']
+        assert ret['patches'][0]['data']['power_state'] is False
+
+
+class TestEventCoalescer(unittest.TestCase):
+    """
+    test coalesced publishing of change events
+    """
+
+    @async_test
+    async def test_merge_and_order(self):
+        published = []
+        events = EventCoalescer(lambda topic, payload: published.append((topic, payload)), window=0.02)
+        events.add('places', 'place1', 1)
+        events.add('resources', 'res1', 'a')
+        events.add('places', 'place2', 2)
+        events.add('places', 'place1', 3)
+        assert len(events) == 3
+        await asyncio.sleep(0.05)
+        assert published == [('places', [2, 3]), ('resources', ['a'])]
+
+    @async_test
+    async def test_max_latency(self):
+        published = []
+        events = EventCoalescer(lambda topic, payload: published.append(payload), window=0.02, max_latency=0.05)
+        for i in range(10):  # a steady storm never leaves a quiet window
+            events.add('resources', i, i)
+            await asyncio.sleep(0.01)
+        assert published and published[0][0] == 0
+        events.flush()
+        assert sum(len(batch) for batch in published) == 10
+
+    @async_test
+    async def test_publish_failure(self):
+        published = []
+
+        def _publish(topic, payload):
+            if topic == 'places':
+                raise ConnectionError("frontend gone")
+            published.append((topic, payload))
+        events = EventCoalescer(_publish)
+        events.add('places', 'place1', 1)
+        events.add('resources', 'res1', 'a')
+        events.flush()
+        assert published == [('resources', ['a'])]
+        assert len(events) == 0
+
+    @async_test
+    async def test_add_from_other_thread(self):
+        published = []
+        events = EventCoalescer(lambda topic, payload: published.append(payload), window=0.02,
+                                loop=asyncio.get_event_loop())
+        await asyncio.get_event_loop().run_in_executor(None, events.add, 'places', 'place1', 1)
+        await asyncio.sleep(0.05)
+        assert published == [[1]]
+
+
+class TestScopedTopics(unittest.TestCase):
+    """
+    test per place and per resource group topics
+    """
+
+    def test_topic_names(self):
+        assert resource_topic('exporter1', 'group.1 a') == 'localhost.resources.exporter1.group_1_a.changed'
+
+    @async_test
+    @patch.object(ApplicationSession, 'publish')
+    async def test_scoped_publish(self, _):
+        client = LabbyClient(config=MagicMock())
+        client.places.seed(copy.deepcopy(PLACES), last_refresh=1.)
+        client.resources.seed(copy.deepcopy(RESOURCES), last_refresh=1.)
+        client.power_states.rebuild(client.places.get_soft(), client.resources.get_soft())
+        await client.on_resource_changed('exporter1', 'mle-lg-ref-1', 'NetworkService', {})
+        await client.on_place_changed('mle-lg-ref-1', {**PLACES['mle-lg-ref-1'], 'comment': 'changed'})
+        client.events.flush()
+        published = {call[0][0]: call[0][1] for call in client.frontend.publish.call_args_list}
+        assert published['localhost.resources.exporter1.mle-lg-ref-1.changed'][0]['name'] == 'NetworkService'
+        assert published['localhost.places.mle-lg-ref-1.changed'][0]['comment'] == 'changed'
+        assert 'localhost.resources.exporter2.mle-lg-ref-1.changed' not in published
+
+
+class TestBatch(unittest.TestCase):
+    """
+    test batched rpc calls
+    """
+
+    @async_test
+    async def test_batch(self):
+        context = MockSession()
+        order = []
+
+        def bound(name, func):
+            async def call(*args):
+                order.append(name)
+                return await func(context, *args)
+            return call
+        procedures = {name: bound(name, getattr(rpc, name))
+                      for name in ('places', 'resource', 'power_state', 'create_reservation')}
+        results = await rpc.batch(context, procedures, [
+            ["localhost.places", []],
+            ["resource", ["mle-lg-ref-1"]],
+            ["create_reservation", ["place2"]],
+            ["power_state", "mle-lg-ref-1"],
+            ["localhost.unknown"],
+            ["localhost.batch", [[]]],
+            "garbage",
+        ])
+        assert len(results) == 7
+        assert results[0][0]['name'] == 'mle-lg-ref-1'
+        assert 'exporter1' in results[1]
+        assert 'place2' in results[2]
+        assert 'power_state' in results[3]
+        assert results[4]['error']['kind'] == ErrorKind.NOT_FOUND.value
+        assert results[5]['error']['kind'] == ErrorKind.NOT_FOUND.value
+        assert results[6]['error']['kind'] == ErrorKind.INVALID_PARAMETER.value
+        # mutating calls are not reordered
+        assert order == ['places', 'resource', 'create_reservation', 'power_state']
+
+    @async_test
+    async def test_batch_kwargs(self):
+        context = MockSession()
+
+        async def resource_names(*args, **kwargs):
+            return await rpc.resource_names(context, *args, **kwargs)
+        procedures = {'resource_names': resource_names}
+        results = await rpc.batch(context, procedures, [
+            ["resource_names", [], {'limit': 2}],
+            ["resource_names", None, {'details': {}}],
+            ["resource_names", [], ['limit']],
+            ["resource_names", [], {'unknown': 1}],
+        ])
+        assert len(results[0]) == 2
+        assert results[1]['error']['kind'] == ErrorKind.INVALID_PARAMETER.value
+        assert results[2]['error']['kind'] == ErrorKind.INVALID_PARAMETER.value
+        assert results[3]['error']['kind'] == ErrorKind.FAILED.value
+
 
 class TestCreateDelete(unittest.TestCase):
     @async_test
@@ -475,5 +972,715 @@ class TestCreateDelete(unittest.TestCase):
             created, dict), "Create place call failed"
 
 
+class TestCache(unittest.TestCase):
+    """
+    test labby cache
+    """
+
+    @async_test
+    async def test_single_flight(self):
+        """
+        concurrent readers of an empty cache share one refresh
+        """
+        calls = []
+
+        async def refresh(context):
+            calls.append(context)
+            await asyncio.sleep(0.01)
+            return {'key': len(calls)}
+
+        cache = Cache(data=None, refresh_data=refresh,
+                      strategies=[], single_flight=True)
+        ret = await asyncio.gather(*(cache.get(None) for _ in range(5)))
+        assert len(calls) == 1
+        assert all(data == {'key': 1} for data in ret)
+
+    @async_test
+    async def test_single_flight_across_loops(self):
+        """
+        readers on the frontend loop share a refresh started on the labby loop
+        """
+        calls = []
+
+        async def refresh(context):
+            calls.append(context)
+            await asyncio.sleep(0.05)
+            return {'key': len(calls)}
+
+        cache = Cache(data=None, refresh_data=refresh,
+                      strategies=[], single_flight=True)
+        labby_loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=labby_loop.run_forever)
+        thread.start()
+        try:
+            joined = asyncio.run_coroutine_threadsafe(cache.get(None), labby_loop)
+            await asyncio.sleep(0.01)
+            ret = await asyncio.gather(*(cache.get(None) for _ in range(3)))
+            assert await asyncio.wrap_future(joined) == {'key': 1}
+            assert all(data == {'key': 1} for data in ret)
+            assert len(calls) == 1
+        finally:
+            labby_loop.call_soon_threadsafe(labby_loop.stop)
+            thread.join()
+            labby_loop.close()
+
+    @async_test
+    async def test_stale_while_revalidate(self):
+        """
+        expired data is served immediately and refreshed in the background
+        """
+        calls = []
+
+        async def refresh(_):
+            calls.append(None)
+            await asyncio.sleep(0.01)
+            return len(calls)
+
+        cache = Cache(data=None, refresh_data=refresh, strategies=[CounterStrategy(1)],
+                      stale_while_revalidate=True, max_staleness=60.)
+        assert await cache.get(None) == 1
+        assert cache.last_refresh is not None
+        assert await cache.get(None) == 1  # expired, served stale
+        assert await cache.get(None) == 1  # refresh still in flight
+        await asyncio.sleep(0.05)
+        assert len(calls) == 2
+        assert cache.get_soft() == 2
+
+        cache.last_refresh -= 120.  # exceed max staleness, block on refresh
+        assert await cache.get(None) == 3
+
+    @async_test
+    async def test_apply_deltas(self):
+        """
+        deltas keep the cache current, full refresh only after a gap
+        """
+        calls = []
+
+        async def refresh(_):
+            calls.append(None)
+            await asyncio.sleep(0.01)
+            return {'place1': 1}
+
+        cache = Cache(data=None, refresh_data=refresh,
+                      strategies=[], single_flight=True)
+        pending = asyncio.ensure_future(cache.get(None))
+        await asyncio.sleep(0)
+        # delta received while the seeding refresh is in flight gets replayed
+        assert cache.apply(lambda data: data.update(place2=2))
+        assert await pending == {'place1': 1, 'place2': 2}
+        version = cache.version
+
+        assert cache.apply(lambda data: data.update(place3=3))
+        assert cache.version == version + 1
+        assert (await cache.get(None))['place3'] == 3
+        assert len(calls) == 1
+
+        # a delta that does not fit the data is a gap
+        assert not cache.apply(lambda data: data.pop('missing'))
+        await cache.get(None)
+        assert len(calls) == 2
+
+
+class TestPowerStateEngine(unittest.TestCase):
+    """
+    test incremental power state maintenance
+    """
+
+    def test_update_flips(self):
+        places = copy.deepcopy(PLACES)
+        resources = copy.deepcopy(RESOURCES)
+        name = 'mle-lg-ref-1'
+        power = PowerStates()
+        assert power.update(name, places, resources) is None  # not built yet
+        power.rebuild(places, resources)
+        assert power.states[name]
+        assert power.update(name, places, resources) is None  # unchanged
+        places[name]['acquired_resources'] = []
+        assert power.update(name, places, resources) is False
+
+    @async_test
+    async def test_publish_on_flip(self):
+        client = LabbyClient(config=MagicMock())
+        name = 'mle-lg-ref-1'
+        client.places.seed(copy.deepcopy(PLACES), last_refresh=1.)
+        client.resources.seed(copy.deepcopy(RESOURCES), last_refresh=1.)
+        client.power_states.rebuild(client.places.get_soft(), client.resources.get_soft())
+        await client.on_place_changed(name, {**PLACES[name], 'acquired_resources': []})
+        client.events.flush()
+        client.frontend.publish.assert_any_call("localhost.onPowerStateChanged",
+                                                [{'name': name, 'power_state': False}])
+        client.frontend.publish.reset_mock()
+        await client.on_place_changed(name, {**PLACES[name], 'acquired_resources': []})
+        client.events.flush()
+        for call in client.frontend.publish.call_args_list:
+            assert call[0][0] != "localhost.onPowerStateChanged"
+
+
+class TestResourceIndex(unittest.TestCase):
+    """
+    test secondary indexes over resources
+    """
+
+    def test_lookup_update(self):
+        index = ResourceIndex()
+        index.rebuild(RESOURCES)
+        keys = index.lookup(group='mle-lg-ref-1', cls='NetworkSerialPort')
+        assert keys == {('exporter1', 'mle-lg-ref-1', 'USBSerialPort')}
+        index.update('exporter1', 'mle-lg-ref-1', 'USBSerialPort', {})
+        assert not index.lookup(group='mle-lg-ref-1', cls='NetworkSerialPort')
+        index.update('exporter3', 'new-group', 'USBSerialPort', {'cls': 'NetworkSerialPort'})
+        assert index.lookup(cls='NetworkSerialPort', exporter='exporter3') == {
+            ('exporter3', 'new-group', 'USBSerialPort')}
+
+    @async_test
+    async def test_rpcs_use_index(self):
+        context = MockSession()
+        overview = await rpc.resource_overview(context, 'mle-lg-ref-1')
+        assert overview
+        assert all(res['place'] == 'mle-lg-ref-1' for res in overview)
+        names = await rpc.resource_names(context)
+        assert len(names) == len(context.resource_index)
+        assert {'exporter': 'exporter1', 'group': 'mle-lg-ref-1',
+                'class': 'NetworkSerialPort', 'name': 'USBSerialPort'} in names
+
+    @async_test
+    @patch.object(ApplicationSession, 'publish')
+    async def test_index_follows_changes(self, _):
+        client = LabbyClient(config=MagicMock())
+        client.resources.seed(copy.deepcopy(RESOURCES), last_refresh=1.)
+        await client.on_resource_changed('exporter9', 'group9', 'port9', {'cls': 'NetworkSerialPort', 'acquired': None})
+        assert ('exporter9', 'group9', 'port9') in client.resource_index
+        await client.on_resource_changed('exporter9', 'group9', 'port9', {})
+        assert ('exporter9', 'group9', 'port9') not in client.resource_index
+        assert 'exporter9' not in client.resources.get_soft()
+        version = client.resources.version
+        # deleting an unknown resource must not create its exporter or group
+        await client.on_resource_changed('exporter8', 'group8', 'port8', {})
+        assert 'exporter8' not in (client.resources.data or {})
+        assert client.resources.version == version
+
+
+class TestConsoleIdle(unittest.TestCase):
+    """
+    test closing of idle consoles
+    """
+
+    @async_test
+    async def test_activity_keeps_console(self):
+        context = MockSession()
+        context.frontend = MagicMock()
+        console = MagicMock(idle_timer=None, last_activity=0.)
+        context.open_consoles['place1'] = console
+        with patch.dict(os.environ, {'LABBY_CONSOLE_IDLE_TIMEOUT': '0.05'}):
+            rpc._watch_console_idle(context, 'place1')
+        loop = asyncio.get_event_loop()
+        for _ in range(4):
+            await asyncio.sleep(0.02)
+            console.last_activity = loop.time()  # output keeps it open
+        assert 'place1' in context.open_consoles
+        await asyncio.sleep(0.1)
+        assert 'place1' not in context.open_consoles
+        console.close.assert_called_once()
+        context.frontend.publish.assert_called_once()
+        assert context.frontend.publish.call_args[0][0] == "localhost.consoles.place1"
+
+    @async_test
+    async def test_off_by_default(self):
+        context = MockSession()
+        console = MagicMock(idle_timer=None)
+        context.open_consoles['place1'] = console
+        with patch.dict(os.environ, {'LABBY_CONSOLE_IDLE_TIMEOUT': ''}):
+            rpc._watch_console_idle(context, 'place1')
+        assert console.idle_timer is None
+        with patch.dict(os.environ, {'LABBY_CONSOLE_IDLE_TIMEOUT': 'soon'}):
+            assert rpc.console_idle_timeout() is None
+
+
+class TestReservationIndex(unittest.TestCase):
+    """
+    test the place to token index of reservations
+    """
+
+    def test_index_follows_dict(self):
+        def reservation(place, state='waiting'):
+            return {'owner': 'labby/test', 'state': state, 'filters': {'main': {'name': place}}}
+        reservations = Reservations(token1=reservation('place1'))
+        reservations['token2'] = reservation('place2')
+        assert reservations.token_for('place1') == 'token1'
+        assert reservations.place_for('token2') == 'place2'
+        reservations['token2'] = reservation('place3')
+        assert reservations.token_for('place2') is None
+        assert reservations.tokens_for('place3') == ['token2']
+        del reservations['token1']
+        assert reservations.token_for('place1') is None
+        reservations.replace({'token4': reservation('place4'), 'bogus': {}})
+        assert reservations.token_for('place3') is None
+        assert reservations.token_for('place4') == 'token4'
+        assert len(reservations) == 2
+
+    def test_replace_reports_changes_only(self):
+        def reservation(place, state='waiting'):
+            return {'owner': 'labby/test', 'state': state, 'filters': {'main': {'name': place}}}
+        reservations = Reservations(token1=reservation('place1'), token2=reservation('place2'))
+        changed: List[str] = []
+        reservations.on_change.append(changed.append)
+        reservations.replace({'token1': reservation('place1', 'allocated'), 'token2': reservation('place2')})
+        reservations['token1'] = reservation('place1', 'acquired')
+        assert changed == []
+        reservations.replace({'token1': reservation('place1'), 'token3': reservation('place3')})
+        assert changed == ['place2', 'place3']
+
+    @async_test
+    async def test_rpcs_use_index(self):
+        context = MockSession()
+        await rpc.create_reservation(context, "place2")
+        assert context.reservations.token_for('place2') == 'place2'
+        assert await rpc.cancel_reservation(context, "place2") is True
+        assert context.reservations.token_for('place2') is None
+
+
+class TestMatchIndex(unittest.TestCase):
+    """
+    test resolution of place matches to resources
+    """
+
+    def test_resolve_and_update(self):
+        index = ResourceIndex()
+        index.rebuild(RESOURCES)
+        matches = MatchIndex()
+        matches.rebuild(PLACES, index)
+        resources = matches.resources_for('mle-lg-ref-1')
+        assert resources == index.lookup(group='mle-lg-ref-1')
+        key = ('exporter1', 'mle-lg-ref-1', 'USBSerialPort')
+        assert matches.places_for(key) == {'mle-lg-ref-1'}
+        place = {'matches': [{'exporter': 'exporter1', 'group': 'mle-*', 'cls': 'Network*', 'name': 'USB?erialPort'}]}
+        matches.update_place('new-place', place, index)
+        assert matches.resources_for('new-place') == {key}
+        index.update('exporter1', 'mle-lg-ref-1', 'USBSerialPort', {})
+        matches.update_resource(key, index)
+        assert not matches.places_for(key)
+        assert not matches.resources_for('new-place')
+        matches.update_place('new-place', None, index)
+        assert 'new-place' not in matches.matches
+
+    @async_test
+    async def test_rpcs(self):
+        context = MockSession()
+        resources = await rpc.place_resources(context, 'mle-lg-ref-1')
+        assert resources
+        assert all(res['place'] == 'mle-lg-ref-1' for res in resources)
+        places = await rpc.resource_places(context, 'exporter1', 'mle-lg-ref-1', 'USBSerialPort')
+        assert places == ['mle-lg-ref-1']
+        missing = await rpc.place_resources(context, 'unknown')
+        assert missing['error']['kind'] == ErrorKind.NOT_FOUND.value
+
+    @async_test
+    @patch.object(ApplicationSession, 'publish')
+    async def test_matches_follow_changes(self, _):
+        client = LabbyClient(config=MagicMock())
+        client.resources.seed(copy.deepcopy(RESOURCES), last_refresh=1.)
+        client.places.seed(copy.deepcopy(PLACES), last_refresh=1.)
+        client.matches.rebuild(client.places.get_soft(), client.resource_index)
+        await client.on_resource_changed('exporter9', 'mle-lg-ref-1', 'port9', {'cls': 'NetworkSerialPort', 'acquired': None})
+        assert 'mle-lg-ref-1' in client.matches.places_for(('exporter9', 'mle-lg-ref-1', 'port9'))
+        await client.on_place_changed('mle-lg-ref-1', {**PLACES['mle-lg-ref-1'], 'matches': []})
+        assert not client.matches.resources_for('mle-lg-ref-1')
+
+
+class TestResultCache(unittest.TestCase):
+    """
+    test the result cache for parameterised queries
+    """
+
+    def test_lru_tags(self):
+        results = ResultCache(maxsize=2, ttl=60.)
+        results.put('a', 1, ['group:a'])
+        results.put('b', 2, ['group:b', 'resources'])
+        assert results.get('a') == 1
+        results.put('c', 3, ['group:c'])  # evicts b, least recently used
+        assert results.get('b') is MISSING
+        results.invalidate('group:a')
+        assert results.get('a') is MISSING
+        assert results.get('c') == 3
+        results.ttl = -1.
+        results.put('d', 4, [])
+        assert results.get('d') is MISSING
+
+    @async_test
+    async def test_memoized_rpc(self):
+        context = MockSession()
+        name = next(iter(RESOURCES['exporter1']['mle-lg-ref-1']))
+        ret = await rpc.resource_by_name(context, name)
+        assert ret
+        hits = context.results.stats.hits
+        assert await rpc.resource_by_name(context, name) == ret
+        assert context.results.stats.hits == hits + 1
+        context.results.invalidate(f"name:{name}")
+        misses = context.results.stats.misses
+        await rpc.resource_by_name(context, name)
+        assert context.results.stats.misses == misses + 1
+
+    @async_test
+    async def test_memoized_unhashable(self):
+        context = MockSession()
+        ret = await rpc.resource_by_name(context, ['NetworkService'])
+        assert ret['error']['kind'] == ErrorKind.INVALID_PARAMETER.value
+        assert len(context.results) == 0
+
+    @async_test
+    async def test_invalidate_refreshes(self):
+        context = MockSession()
+        await rpc.fetch_resources(context, 'mle-lg-ref-1', None)
+        context.resources.invalidate()
+        assert len(context.results) == 0
+        with patch.object(MockSession, 'call', wraps=context.call) as call:
+            await rpc.fetch_resources(context, None, None)
+            # stale data is served, while it is refreshed in the background
+            await asyncio.sleep(0.01)
+        call.assert_called_once_with("org.labgrid.coordinator.get_resources")
+
+
+class TestStats(unittest.TestCase):
+    """
+    test cache telemetry
+    """
+
+    @async_test
+    async def test_cache_stats(self):
+        context = MockSession()
+        await rpc.places(context)
+        await rpc.places(context)
+        ret = await rpc.stats(context)
+        assert ret['caches']['places']['misses'] == 1
+        assert ret['caches']['places']['hits'] >= 1
+        assert ret['caches']['places']['refreshes'] == 1
+        assert ret['caches']['places']['payload_bytes'] > 0
+        assert ret['caches']['power_states']['misses'] >= 1
+        text = context.stats.to_prometheus()
+        assert 'labby_cache_hits_total{cache="places"}' in text
+        assert 'labby_cache_refresh_seconds_bucket{cache="places",le="+Inf"} 1' in text
+
+    def test_payload_size_lazy(self):
+        context = MockSession()
+        with patch('labby.stats.payload_size', return_value=42) as size:
+            for _ in range(3):
+                context.stats.cache('resources').refreshed(0.01, RESOURCES)
+            size.assert_not_called()
+            assert context.stats.to_json()['caches']['resources']['payload_bytes'] == 42
+            assert context.stats.cache('resources').payload_bytes == 42
+        size.assert_called_once_with(RESOURCES)
+
+
+class TestEndpointMetrics(unittest.TestCase):
+    """
+    test per endpoint metrics recorded by RouterInterface.register
+    """
+
+    @async_test
+    async def test_register_records_metrics(self):
+        client = RouterInterface(MagicMock())
+        client.labby = MockSession()
+        with patch.object(ApplicationSession, 'register') as register:
+            client.register("places", rpc.places)
+            client.register("power_state", rpc.power_state)
+        places_bind, power_bind = (call[0][0] for call in register.call_args_list)
+        await places_bind()
+        await places_bind()
+        await power_bind('unknown place')
+        metrics = await rpc.metrics(client.labby)
+        assert metrics['places']['calls'] == 2
+        assert metrics['places']['errors'] == {}
+        assert metrics['places']['in_flight'] == 0
+        assert metrics['power_state']['errors'] == {ErrorKind.NOT_FOUND.value: 1}
+        assert metrics['places']['latency']['count'] == 2
+        text = client.labby.stats.to_prometheus()
+        assert 'labby_rpc_calls_total{endpoint="places"} 2' in text
+        assert 'labby_rpc_errors_total{endpoint="power_state",kind="NotFound"} 1' in text
+
+    @async_test
+    @patch.object(ApplicationSession, 'call')
+    async def test_coordinator_time(self, call):
+        async def slow_call(*_, **__):
+            await asyncio.sleep(0.02)
+            return {}
+        call.side_effect = slow_call
+        session = Session()
+        with coordinator_time() as outer:
+            with coordinator_time() as inner:
+                await asyncio.gather(session.call('a'), session.call('b'))
+        assert inner[0] >= 0.04
+        assert outer[0] == inner[0]
+
+
+class TestAdmission(unittest.TestCase):
+    """
+    test per endpoint admission control
+    """
+
+    @async_test
+    async def test_limiter_queue(self):
+        limiter = Limiter(1, 1)
+        assert await limiter.acquire()
+        waiter = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        assert limiter.queued == 1
+        # queue is full
+        assert not await limiter.acquire()
+        assert limiter.rejected == 1
+        limiter.release()
+        assert await waiter
+        assert limiter.running == 1
+        limiter.release()
+        assert limiter.running == 0
+
+    @async_test
+    async def test_read_lane_not_starved(self):
+        admission = AdmissionControl({'places'}, {'cli_command': (1, 1)}, read_lane=(1, 0), default_lane=(1, 0))
+        cli = await admission.admit('cli_command')
+        assert cli is not None
+        # cli_command is busy, its queue takes one more
+        queued = asyncio.ensure_future(admission.admit('cli_command'))
+        await asyncio.sleep(0)
+        assert await admission.admit('cli_command') is None
+        assert await admission.admit('reset') is None
+        read = await admission.admit('places')
+        assert read is not None
+        admission.release(read)
+        admission.release(cli)
+        admission.release(await queued)
+        assert admission.default_lane.running == 0
+        assert await admission.admit('batch') == []
+
+    def test_parse_limits(self):
+        assert parse_limits('cli_command=2:8, reset=1') == {'cli_command': (2, 8), 'reset': (1, 0)}
+        assert parse_limits('') == {}
+        with patch.dict(os.environ, {'LABBY_ENDPOINT_LIMITS': 'cli_command=two'}):
+            admission = AdmissionControl.from_env({'places'})
+        assert admission.endpoints['cli_command'].limit == 2
+
+    @async_test
+    async def test_register_rejects(self):
+        client = RouterInterface(MagicMock())
+        client.labby = MockSession()
+        client.admission = AdmissionControl(rpc.READ_ONLY_ENDPOINTS, {'power_state': (1, 0)})
+        release = asyncio.Event()
+
+        async def blocking(_context):
+            await release.wait()
+            return True
+        with patch.object(ApplicationSession, 'register') as register:
+            client.register("power_state", blocking)
+        bind = register.call_args[0][0]
+        first = asyncio.ensure_future(bind())
+        await asyncio.sleep(0)
+        ret = await bind()
+        assert ret['error']['kind'] == ErrorKind.OVERLOADED.value
+        release.set()
+        assert await first
+        metrics = await rpc.metrics(client.labby)
+        assert metrics['power_state']['errors'] == {ErrorKind.OVERLOADED.value: 1}
+
+
+class TestClients(unittest.TestCase):
+    """
+    test frontend sessions served by one labby
+    """
+
+    @async_test
+    async def test_sessions_acquire(self):
+        context = MockSession()
+        context.clients.server_mode = True
+        first = context.clients.for_caller(1, 'alice')
+        second = context.clients.for_caller(2)
+        with patch.object(MockSession, 'call', mock.AsyncMock(return_value=True)):
+            with context.clients.use(first):
+                assert await rpc.acquire(context, 'place1') is True
+        assert context.clients.holder('place1') is first
+        with context.clients.use(second):
+            ret = await rpc.acquire(context, 'place1')
+            assert ret['error']['kind'] == ErrorKind.FAILED.value
+            assert 'place1' not in context.acquired_places
+            assert await rpc.username(context) == 'session/2'
+        # places of a session that left can be adopted
+        context.clients.leave(1)
+        with context.clients.use(second):
+            assert await rpc.acquire(context, 'place1') is True
+            assert 'place1' in context.acquired_places
+        assert context.clients.holder('place1') is second
+        context.clients.sync('place1', False)
+        assert context.clients.holder('place1') is None
+
+    @async_test
+    async def test_reservation_acquired_for_session(self):
+        context = MockSession()
+        context.clients.server_mode = True
+        alice = context.clients.for_caller(1, 'alice')
+        reservation = {'owner': context.user_name, 'state': 'waiting', 'filters': {'main': {'name': 'place2'}}}
+        reservations: Dict[str, Dict] = {}
+
+        async def call(func_str, *args, **_):
+            if func_str == "org.labgrid.coordinator.create_reservation":
+                reservations['token2'] = dict(reservation)
+                return {'token2': dict(reservation)}
+            if func_str == "org.labgrid.coordinator.get_reservations":
+                return copy.deepcopy(reservations)
+            if func_str == "org.labgrid.coordinator.cancel_reservation":
+                return reservations.pop(args[0], None) is not None
+            return True
+        context.call = call
+        with context.clients.use(alice):
+            await rpc.create_reservation(context, "place2")
+        reservations['token2']['state'] = 'allocated'
+        context.reservation_data.invalidate()
+        task = asyncio.ensure_future(rpc.refresh_reservations(context))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        assert context.clients.holder('place2') is alice
+        assert not context.clients.reserved_by
+
+    def test_shared_without_server_mode(self):
+        clients = Clients()
+        assert clients.for_caller(1, 'alice') is clients.default
+        assert clients.current() is clients.default
+        clients.sync('place1', True)
+        assert clients.holder('place1') is clients.default
+
+    @async_test
+    async def test_register_uses_caller(self):
+        client = RouterInterface(MagicMock())
+        client.labby = MockSession()
+        client.labby.clients.server_mode = True
+        with patch.object(ApplicationSession, 'register') as register:
+            client.register("username", rpc.username)
+        bind = register.call_args[0][0]
+        assert await bind(details=MagicMock(caller=7, caller_authid='alice')) == 'alice'
+        assert await bind(details=MagicMock(caller=8, caller_authid=None)) == 'session/8'
+        assert await bind() == client.labby.user_name
+        client.on_session_left(7)
+        assert set(client.labby.clients.sessions) == {8}
+
+    @async_test
+    async def test_batch_uses_caller(self):
+        client = RouterInterface(MagicMock())
+        client.labby = MockSession()
+        client.labby.clients.server_mode = True
+        with patch.object(ApplicationSession, 'register') as register:
+            client.register("username", rpc.username)
+            client.register("batch", rpc.batch, client.procedures)
+        batch_bind = register.call_args[0][0]
+        ret = await batch_bind([['username']], details=MagicMock(caller=7, caller_authid='alice'))
+        assert ret == ['alice']
+
+
+class TestSnapshot(unittest.TestCase):
+    """
+    test warm start from cache snapshots
+    """
+
+    def setUp(self):
+        self.sessions = list(labby_module.labby_sessions), list(labby_module.frontend_sessions)
+
+    def tearDown(self):
+        labby_module.labby_sessions[:], labby_module.frontend_sessions[:] = self.sessions
+
+    @async_test
+    async def test_snapshot_roundtrip(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'snapshot')
+            assert save_snapshot(path, {'places': {'data': PLACES, 'version': 3, 'last_refresh': 1.}})
+            caches = load_snapshot(path)
+            assert caches['places']['data'] == PLACES
+
+            context = MockSession()
+            context.places.seed(caches['places']['data'], version=3, last_refresh=1.)
+            context.places.max_staleness = 1.
+            ret = await rpc.places(context)
+            # served from the snapshot, refreshed in the background
+            assert all(place['stale'] for place in ret)
+            await asyncio.sleep(0.01)
+            assert not context.places.stale
+            assert context.places.version > 3
+
+    def test_no_snapshot(self):
+        assert load_snapshot('does/not/exist') is None
+
+    @async_test
+    async def test_serve_snapshot_before_coordinator(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'snapshot')
+            assert save_snapshot(path, {'places': {'data': PLACES, 'version': 3, 'last_refresh': 1.},
+                                        'resources': {'data': RESOURCES, 'version': 2, 'last_refresh': 1.}})
+            router = RouterInterface(MagicMock())
+            router.backend_realm = 'realm1'
+            with patch.dict(os.environ, {'LABBY_SNAPSHOT_PATH': path}), \
+                    patch('labby.labby.labby_sessions', []), patch('labby.labby._start_labby'), \
+                    patch.object(ApplicationSession, 'register') as register, \
+                    patch.object(ApplicationSession, 'subscribe'), \
+                    patch.object(ApplicationSession, 'publish'):
+                joining = asyncio.ensure_future(router.onJoin(None))
+                await asyncio.sleep(0.01)
+                registered = {call[0][1] for call in register.call_args_list}
+                assert 'localhost.places' in registered
+                assert 'localhost.acquire' not in registered
+                ret = await router.procedures['places']()
+                assert {place['name'] for place in ret} == set(PLACES)
+                assert all(place['stale'] for place in ret)
+                # the coordinator session is up
+                router.labby.offline = False
+                await asyncio.wait_for(joining, 1.)
+                registered = {call[0][1] for call in register.call_args_list}
+                assert 'localhost.acquire' in registered
+
+
+class TestScheduler(unittest.TestCase):
+    """
+    test the shared timer scheduler
+    """
+
+    @async_test
+    async def test_schedule_cancel(self):
+        scheduler = Scheduler(asyncio.get_event_loop())
+        fired = []
+        scheduler.call_later(0.02, fired.append, 2)
+        scheduler.call_later(0.01, fired.append, 1)
+        cancelled = scheduler.call_later(0.01, fired.append, 3)
+        cancelled.cancel()
+        assert len(scheduler) == 2
+        await scheduler.sleep(0.05)
+        assert fired == [1, 2]
+        assert len(scheduler) == 0
+        # one wakeup per distinct deadline, plus the sleep
+        assert scheduler.wakeups <= 3
+
+    @async_test
+    async def test_wakeup(self):
+        wakeup = Wakeup()
+        assert not await wakeup.wait(0.01)
+        wakeup.set()  # kept until the next wait
+        assert await wakeup.wait(0.01)
+        loop = asyncio.get_event_loop()
+        loop.call_later(0.01, wakeup.set)
+        assert await wakeup.wait()
+        # from another thread, e.g. the frontend router's loop
+        loop.call_later(0.01, lambda: threading.Thread(target=wakeup.set).start())
+        assert await wakeup.wait(1.)
+
+    @async_test
+    async def test_periodic_refresh(self):
+        scheduler = Scheduler(asyncio.get_event_loop())
+        strategy = PeriodicRefreshStrategy(0.01, scheduler=scheduler)
+        assert not strategy.should_refresh()
+        await asyncio.sleep(0.03)
+        assert strategy.should_refresh()
+        wakeups = scheduler.wakeups
+        await asyncio.sleep(0.03)
+        # no wakeups while expired
+        assert scheduler.wakeups == wakeups
+        strategy.reset()
+        assert not strategy.should_refresh()
+        strategy.stop()
+        assert len(scheduler) == 0
+
+
 if __name__ == "__main__":
     unittest.main()